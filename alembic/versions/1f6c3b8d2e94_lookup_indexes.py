@@ -0,0 +1,30 @@
+"""lookup indexes
+
+Revision ID: 1f6c3b8d2e94
+Revises: 7d4a9e2c5b18
+Create Date: 2026-10-17 16:41:09.205573
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f6c3b8d2e94'
+down_revision = '7d4a9e2c5b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_accounts_user_id_currency_code', 'accounts', ['user_id', 'currency_code'], unique=True)
+    op.create_index('ix_update_requests_user_id_confirmation_code', 'update_requests',
+                    ['user_id', 'confirmation_code'], unique=False)
+    op.create_index('ix_users_confirmation_code', 'users', ['confirmation_code'], unique=False,
+                    postgresql_where=sa.text('confirmation_code IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_users_confirmation_code', table_name='users')
+    op.drop_index('ix_update_requests_user_id_confirmation_code', table_name='update_requests')
+    op.drop_index('ix_accounts_user_id_currency_code', table_name='accounts')
@@ -0,0 +1,30 @@
+"""currency rates history
+
+Revision ID: 3a1f9c0b7e52
+Revises: de7dfaebc94e
+Create Date: 2026-10-17 11:48:05.117304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1f9c0b7e52'
+down_revision = 'de7dfaebc94e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('currency_rates_history',
+    sa.Column('char_code', sa.String(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('value', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['char_code'], ['currencies.char_code'], ),
+    sa.PrimaryKeyConstraint('char_code', 'date')
+    )
+
+
+def downgrade():
+    op.drop_table('currency_rates_history')
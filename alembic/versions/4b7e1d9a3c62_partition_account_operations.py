@@ -0,0 +1,84 @@
+"""partition account operations
+
+Revision ID: 4b7e1d9a3c62
+Revises: 1f6c3b8d2e94
+Create Date: 2026-10-17 17:22:48.630417
+
+"""
+from datetime import date, datetime
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e1d9a3c62'
+down_revision = '1f6c3b8d2e94'
+branch_labels = None
+depends_on = None
+
+# Partitions are created up to this many months ahead, then by the create_operation_partitions task
+PARTITIONS_AHEAD = 3
+
+COLUMNS = 'id, account_id, amount_diff, created_at, description'
+
+
+def add_months(month: date, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_table(name: str, partitioned: bool):
+    op.create_table(
+        name,
+        sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('amount_diff', sa.Numeric(20, 2), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], name='{}_account_id_fkey'.format(name),
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint(*(['id', 'created_at'] if partitioned else ['id']), name='{}_pkey'.format(name)),
+        **({'postgresql_partition_by': 'RANGE (created_at)'} if partitioned else {}))
+    op.create_index('ix_{}_account_id_created_at'.format(name), name, ['account_id', 'created_at', 'id'])
+
+
+def rename_table(name: str, new_name: str):
+    op.rename_table(name, new_name)
+    op.execute('ALTER TABLE {} RENAME CONSTRAINT {}_pkey TO {}_pkey'.format(new_name, name, new_name))
+    op.execute('ALTER TABLE {} RENAME CONSTRAINT {}_account_id_fkey TO {}_account_id_fkey'.format(
+        new_name, name, new_name))
+    op.execute('ALTER INDEX ix_{}_account_id_created_at RENAME TO ix_{}_account_id_created_at'.format(
+        name, new_name))
+
+
+def upgrade():
+    # Rows are copied to monthly partitions covering the existing history, the table is locked meanwhile
+    rename_table('account_operations', 'account_operations_unpartitioned')
+    create_table('account_operations', partitioned=True)
+
+    current_month = add_months(datetime.utcnow().date(), 0)
+    first_operation = op.get_bind().execute(
+        sa.text('SELECT min(created_at) FROM account_operations_unpartitioned')).scalar()
+    month = add_months(min(first_operation.date(), current_month) if first_operation else current_month, 0)
+    while month <= add_months(current_month, PARTITIONS_AHEAD):
+        next_month = add_months(month, 1)
+        op.execute("CREATE TABLE account_operations_y{:04d}m{:02d} PARTITION OF account_operations "
+                   "FOR VALUES FROM ('{}') TO ('{}')".format(
+                       month.year, month.month, month.isoformat(), next_month.isoformat()))
+        month = next_month
+
+    op.execute('INSERT INTO account_operations ({columns}) SELECT {columns} FROM account_operations_unpartitioned'.
+               format(columns=COLUMNS))
+    op.drop_table('account_operations_unpartitioned')
+    op.execute('ANALYZE account_operations')
+
+
+def downgrade():
+    # Rows of detached partitions are not returned to the table
+    rename_table('account_operations', 'account_operations_partitioned')
+    create_table('account_operations', partitioned=False)
+    op.execute('INSERT INTO account_operations ({columns}) SELECT {columns} FROM account_operations_partitioned'.
+               format(columns=COLUMNS))
+    op.execute('DROP TABLE account_operations_partitioned CASCADE')
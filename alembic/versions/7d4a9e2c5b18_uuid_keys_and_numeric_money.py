@@ -0,0 +1,87 @@
+"""uuid keys and numeric money
+
+Revision ID: 7d4a9e2c5b18
+Revises: b6f3e2a91c07
+Create Date: 2026-10-17 16:02:37.418825
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4a9e2c5b18'
+down_revision = 'b6f3e2a91c07'
+branch_labels = None
+depends_on = None
+
+# (table, column, referenced table, ondelete)
+FOREIGN_KEYS = [
+    ('update_requests', 'user_id', 'users', None),
+    ('accounts', 'user_id', 'users', None),
+    ('account_operations', 'account_id', 'accounts', 'CASCADE'),
+    ('idempotency_keys', 'user_id', 'users', None),
+    ('account_balance_snapshots', 'account_id', 'accounts', 'CASCADE'),
+]
+
+UUID_COLUMNS = [
+    ('users', 'id'),
+    ('update_requests', 'id'),
+    ('update_requests', 'user_id'),
+    ('accounts', 'id'),
+    ('accounts', 'user_id'),
+    ('account_operations', 'id'),
+    ('account_operations', 'account_id'),
+    ('email_outbox', 'id'),
+    ('idempotency_keys', 'user_id'),
+    ('account_balance_snapshots', 'account_id'),
+]
+
+MONEY_COLUMNS = [
+    ('accounts', 'amount'),
+    ('account_operations', 'amount_diff'),
+    ('account_balance_snapshots', 'amount'),
+    ('account_balance_snapshots', 'total_in'),
+    ('account_balance_snapshots', 'total_out'),
+]
+
+RATE_COLUMNS = [
+    ('currencies', 'value'),
+    ('currency_rates_history', 'value'),
+]
+
+
+def drop_foreign_keys():
+    for table, column, _, _ in FOREIGN_KEYS:
+        op.drop_constraint('{}_{}_fkey'.format(table, column), table, type_='foreignkey')
+
+
+def create_foreign_keys():
+    for table, column, referent, ondelete in FOREIGN_KEYS:
+        op.create_foreign_key('{}_{}_fkey'.format(table, column), table, referent, [column], ['id'],
+                              ondelete=ondelete)
+
+
+def upgrade():
+    drop_foreign_keys()
+    for table, column in UUID_COLUMNS:
+        op.alter_column(table, column, type_=postgresql.UUID(as_uuid=True),
+                        postgresql_using='{}::uuid'.format(column))
+    for table, column in MONEY_COLUMNS:
+        op.alter_column(table, column, type_=sa.Numeric(20, 2),
+                        postgresql_using='round({}::numeric, 2)'.format(column))
+    for table, column in RATE_COLUMNS:
+        op.alter_column(table, column, type_=sa.Numeric(20, 4),
+                        postgresql_using='round({}::numeric, 4)'.format(column))
+    create_foreign_keys()
+
+
+def downgrade():
+    drop_foreign_keys()
+    for table, column in RATE_COLUMNS + MONEY_COLUMNS:
+        op.alter_column(table, column, type_=sa.Float(),
+                        postgresql_using='{}::double precision'.format(column))
+    for table, column in UUID_COLUMNS:
+        op.alter_column(table, column, type_=sa.String(), postgresql_using='{}::text'.format(column))
+    create_foreign_keys()
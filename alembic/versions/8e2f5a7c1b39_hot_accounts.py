@@ -0,0 +1,39 @@
+"""hot accounts
+
+Revision ID: 8e2f5a7c1b39
+Revises: 4b7e1d9a3c62
+Create Date: 2026-10-17 17:58:14.092716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2f5a7c1b39'
+down_revision = '4b7e1d9a3c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('accounts', sa.Column('is_hot', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_table('account_pending_credits',
+                    sa.Column('operation_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('amount_diff', sa.Numeric(20, 2), nullable=False),
+                    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('operation_id'))
+    op.create_index('ix_account_pending_credits_account_id', 'account_pending_credits', ['account_id'],
+                    unique=False)
+
+
+def downgrade():
+    # Pending credits are added to the balances before the table is dropped
+    op.execute('UPDATE accounts SET amount = accounts.amount + pending.amount_diff '
+               'FROM (SELECT account_id, sum(amount_diff) AS amount_diff FROM account_pending_credits '
+               'GROUP BY account_id) pending WHERE accounts.id = pending.account_id')
+    op.drop_index('ix_account_pending_credits_account_id', table_name='account_pending_credits')
+    op.drop_table('account_pending_credits')
+    op.drop_column('accounts', 'is_hot')
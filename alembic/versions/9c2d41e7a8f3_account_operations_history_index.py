@@ -0,0 +1,25 @@
+"""account operations history index
+
+Revision ID: 9c2d41e7a8f3
+Revises: 3a1f9c0b7e52
+Create Date: 2026-10-17 13:05:44.630918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c2d41e7a8f3'
+down_revision = '3a1f9c0b7e52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_account_operations_account_id_created_at', 'account_operations',
+                    ['account_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_account_operations_account_id_created_at', table_name='account_operations')
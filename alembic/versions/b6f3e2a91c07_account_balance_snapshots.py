@@ -0,0 +1,32 @@
+"""account balance snapshots
+
+Revision ID: b6f3e2a91c07
+Revises: 5e8b07c3d4a1
+Create Date: 2026-10-17 15:02:37.215649
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6f3e2a91c07'
+down_revision = '5e8b07c3d4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('account_balance_snapshots',
+    sa.Column('account_id', sa.String(), nullable=False),
+    sa.Column('taken_at', sa.DateTime(), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('total_in', sa.Float(), nullable=False),
+    sa.Column('total_out', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('account_id', 'taken_at')
+    )
+
+
+def downgrade():
+    op.drop_table('account_balance_snapshots')
@@ -0,0 +1,124 @@
+import asyncio
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import BigInteger, cast, func, select, true
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from controller import AccountBalance
+from db import db, replica_reads
+from models import accounts, account_operations
+from schema import AccountAnalyticsDay, AccountAnalyticsEntry
+
+# Amounts are aggregated in minor units (kopecks) as int64, times in microseconds since the epoch
+MINOR_UNITS = 100
+DAY = 86400 * 10 ** 6
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def to_money(value):
+    return Decimal(int(value)).scaleb(-2)
+
+
+class AccountAnalytics:
+    @staticmethod
+    def aggregate(opening: int, amounts: np.ndarray, times: np.ndarray):
+        """
+        Computes aggregates of the window with vectorized operations
+        :param opening: balance before the first operation in minor units
+        :param amounts: amount_diff of operations in minor units (int64) ordered by created_at
+        :param times: created_at of operations in microseconds since the epoch (int64) in the same order
+        :return: dict of window totals and per day arrays (days since the epoch, inflow, outflow, operations,
+        closing, min and max balance), only days with operations are included
+        """
+        if not len(amounts):
+            empty = np.empty(0, dtype=np.int64)
+            return {'closing_balance': opening, 'inflow': 0, 'outflow': 0, 'min_balance': opening,
+                    'max_balance': opening, 'operations': 0, 'days': empty, 'day_inflow': empty,
+                    'day_outflow': empty, 'day_operations': empty, 'day_closing': empty, 'day_min': empty,
+                    'day_max': empty}
+        balances = opening + np.cumsum(amounts)
+        inflow = np.where(amounts > 0, amounts, 0)
+        outflow = np.where(amounts < 0, -amounts, 0)
+        days = times // DAY
+        # Operations are ordered by time, so every day is a contiguous run starting at these positions
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        ends = np.r_[starts[1:], len(amounts)] - 1
+        # Balance before the first operation of the day is a balance of the day too
+        day_opening = np.r_[opening, balances[ends[:-1]]]
+        return {
+            'closing_balance': int(balances[-1]),
+            'inflow': int(inflow.sum()),
+            'outflow': int(outflow.sum()),
+            'min_balance': min(opening, int(balances.min())),
+            'max_balance': max(opening, int(balances.max())),
+            'operations': len(amounts),
+            'days': days[starts],
+            'day_inflow': np.add.reduceat(inflow, starts),
+            'day_outflow': np.add.reduceat(outflow, starts),
+            'day_operations': ends - starts + 1,
+            'day_closing': balances[ends],
+            'day_min': np.minimum(np.minimum.reduceat(balances, starts), day_opening),
+            'day_max': np.maximum(np.maximum.reduceat(balances, starts), day_opening),
+        }
+
+    @classmethod
+    def summarize(cls, account_id: uuid.UUID, date_from: datetime, date_to: datetime, opening: Decimal,
+                  amounts: list, times: list):
+        """
+        Builds analytics of the window from the loaded columns, CPU bound, runs outside of the event loop
+        :param account_id: account id
+        :param date_from: period start
+        :param date_to: period end
+        :param opening: balance at the period start
+        :param amounts: amount_diff of operations in minor units ordered by created_at
+        :param times: created_at of operations in microseconds since the epoch in the same order
+        :return: account analytics data
+        """
+        result = cls.aggregate(int(opening * MINOR_UNITS), np.array(amounts or (), dtype=np.int64),
+                               np.array(times or (), dtype=np.int64))
+        days = [
+            AccountAnalyticsDay(
+                date=date.fromordinal(EPOCH_ORDINAL + int(day)), operations=int(operations),
+                inflow=to_money(inflow), outflow=to_money(outflow), closing_balance=to_money(closing),
+                min_balance=to_money(min_balance), max_balance=to_money(max_balance))
+            for day, operations, inflow, outflow, closing, min_balance, max_balance in zip(
+                result['days'], result['day_operations'], result['day_inflow'], result['day_outflow'],
+                result['day_closing'], result['day_min'], result['day_max'])]
+        return AccountAnalyticsEntry(
+            account_id=account_id, date_from=date_from, date_to=date_to, opening_balance=opening,
+            closing_balance=to_money(result['closing_balance']), inflow=to_money(result['inflow']),
+            outflow=to_money(result['outflow']), min_balance=to_money(result['min_balance']),
+            max_balance=to_money(result['max_balance']), operations=result['operations'], days=days)
+
+    @classmethod
+    @replica_reads
+    async def get(cls, account_id: uuid.UUID, date_from: datetime, date_to: datetime):
+        """
+        Returns daily turnover, balances and totals of the account for the period (operations created at or after
+        date_from and before date_to, like the history). Operations are loaded in one query as two arrays instead of
+        a row per operation.
+        :param account_id: account id
+        :param date_from: period start
+        :param date_to: period end
+        :return: account analytics data
+        """
+        opening = AccountBalance.state_query(date_from).where(accounts.c.id == account_id).subquery('opening')
+        order = (account_operations.c.created_at, account_operations.c.id)
+        operations = select(
+            func.array_agg(aggregate_order_by(
+                cast(account_operations.c.amount_diff * MINOR_UNITS, BigInteger), *order)).label('amounts'),
+            func.array_agg(aggregate_order_by(
+                cast(func.extract('epoch', account_operations.c.created_at) * 10 ** 6, BigInteger),
+                *order)).label('times')).\
+            where(account_operations.c.account_id == account_id,
+                  account_operations.c.created_at >= date_from,
+                  account_operations.c.created_at < date_to).\
+            subquery('operations')
+        query = select(opening.c.amount, operations.c.amounts, operations.c.times).\
+            select_from(opening.join(operations, true()))
+        row = await db.fetch_one(query)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, cls.summarize, account_id, date_from, date_to, row['amount'], row['amounts'], row['times'])
@@ -1,15 +1,84 @@
+import logging
+import os
+import time
+
+from cbr import rates_fetcher
+from controller import User, Currency
 from db import db
 from fastapi import FastAPI
+from hashing import password_hasher
+from mailer import outbox_sender
+from metrics import Histogram
+from pubsub import pubsub
+from responses import ORJSONResponse
+
+logger = logging.getLogger(__name__)
+
+request_latency = Histogram('http_request_duration_seconds', 'Request handling time by route',
+                            ['method', 'route', 'status'])
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware timing requests by route path template, streamed responses are timed until the last chunk
+    """
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route_path(self, scope):
+        # Router stores the matched endpoint in the request scope
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope['app'].routes if hasattr(route, 'endpoint')}
+        return self.routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_latency.labels(scope['method'], self.route_path(scope), status_code).\
+                observe(time.perf_counter() - started)
 
 
-app = FastAPI(title="FastAPI")
+app = FastAPI(title="FastAPI", default_response_class=ORJSONResponse)
+app.add_middleware(RequestMetricsMiddleware)
 
 
 @app.on_event("startup")
 async def startup():
     await db.connect()
+    await Currency.load_rates()
+    pubsub.subscribe(User.cache_channel, User.cache.delete)
+    # A profile change must not be cached again from a lagging replica by any worker
+    pubsub.subscribe(User.cache_channel, db.mark_written_elsewhere)
+    # Reads of a client go to the primary in every worker after its writes in any of them
+    pubsub.subscribe(db.writes_channel, db.mark_written_elsewhere)
+    db.write_publisher = pubsub.publish
+    if db.replica is not None and not pubsub.enabled:
+        logger.warning('Replica reads without PUBSUB_ENABLED=1: read-your-writes holds only within one worker')
+    pubsub.subscribe(Currency.rates_channel, lambda payload: Currency.load_rates())
+    await pubsub.start()
+    if os.environ.get('OUTBOX_SENDER_ENABLED', '1') == '1':
+        outbox_sender.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await outbox_sender.stop()
+    await pubsub.stop()
+    await rates_fetcher.close()
     await db.disconnect()
+    password_hasher.shutdown()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import time
+from decimal import Decimal
+
+import httpx
+
+from metrics import Histogram
+
+cbr_request_latency = Histogram('cbr_request_duration_seconds', 'Central Bank rates document requests', ['status'])
+
+
+class RatesFetcher:
+    """
+    Client of the Central Bank of Russian Federation daily rates document. Keeps one connection pool, caches the
+    parsed document for CBR_CACHE_TTL seconds and revalidates it with conditional GET.
+    """
+    def __init__(self):
+        self.ttl = float(os.environ.get('CBR_CACHE_TTL', 600))
+        self.timeout = float(os.environ.get('CBR_TIMEOUT', 10))
+        self._client = None
+        self._lock = None
+        self._loop = None
+        self._document = None
+        self._fetched_at = 0.
+        self._etag = None
+        self._last_modified = None
+
+    def _get_client(self):
+        # Client and lock are bound to the event loop, scheduled tasks run each in a new loop
+        loop = asyncio.get_event_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2))
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._client
+
+    async def get_rates(self, force: bool = False):
+        """
+        Returns parsed rates document
+        :param force: revalidate the document even if cached copy is fresh
+        :return: rates document
+        """
+        client = self._get_client()
+        async with self._lock:
+            if not force and self._document is not None and time.monotonic() - self._fetched_at < self.ttl:
+                return self._document
+
+            headers = {}
+            if self._document is not None:
+                if self._etag:
+                    headers['If-None-Match'] = self._etag
+                if self._last_modified:
+                    headers['If-Modified-Since'] = self._last_modified
+            started = time.perf_counter()
+            try:
+                response = await client.get(os.environ['CURRENCIES_BANK_URL'], headers=headers)
+            except httpx.HTTPError:
+                cbr_request_latency.labels('error').observe(time.perf_counter() - started)
+                raise
+            cbr_request_latency.labels(response.status_code).observe(time.perf_counter() - started)
+            if response.status_code != 304:
+                response.raise_for_status()
+                self._document = response.json(parse_float=Decimal)
+                self._etag = response.headers.get('ETag')
+                self._last_modified = response.headers.get('Last-Modified')
+            self._fetched_at = time.monotonic()
+            return self._document
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+rates_fetcher = RatesFetcher()
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from celery import Celery
 from celery.schedules import crontab
 
@@ -10,5 +12,25 @@ celery_app.conf.beat_schedule = {
   'fetch_currencies': {
     'task': 'fetch_currencies',
     'schedule': crontab(minute='0', hour='1'),
+  },
+  'take_balance_snapshots': {
+    'task': 'take_balance_snapshots',
+    'schedule': crontab(minute='15'),
+  },
+  'delete_expired_idempotency_keys': {
+    'task': 'delete_expired_idempotency_keys',
+    'schedule': crontab(minute='30'),
+  },
+  'create_operation_partitions': {
+    'task': 'create_operation_partitions',
+    'schedule': crontab(minute='45', hour='2'),
+  },
+  'detach_operation_partitions': {
+    'task': 'detach_operation_partitions',
+    'schedule': crontab(minute='45', hour='3'),
+  },
+  'rollup_pending_credits': {
+    'task': 'rollup_pending_credits',
+    'schedule': timedelta(seconds=10),
   }
 }
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import logging
+
+from celery.signals import worker_process_init, worker_process_shutdown
+
+from cbr import rates_fetcher
+from db import db
+from .celery import celery_app
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerRuntime:
+    """
+    Event loop and database pool of a worker process. Created once per process on worker_process_init (prefork pool)
+    or by the first task (solo pool), then reused by all async tasks of the process.
+    """
+    def __init__(self):
+        self.loop = None
+
+    def start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(db.connect())
+        except Exception:
+            # The pool is connected again by the next task, a failed start must not kill the process
+            logger.exception('Database connection failed on worker process start')
+
+    def stop(self):
+        if self.loop is None:
+            return
+        try:
+            self.loop.run_until_complete(rates_fetcher.close())
+            self.loop.run_until_complete(db.disconnect())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    async def _call(self, coroutine_function, args, kwargs):
+        # No-op when connected
+        await db.connect()
+        return await coroutine_function(*args, **kwargs)
+
+    def run(self, coroutine_function, *args, **kwargs):
+        """
+        Runs controller coroutine in the event loop of the process
+        :param coroutine_function: coroutine function
+        :return: coroutine result
+        """
+        self.start()
+        return self.loop.run_until_complete(self._call(coroutine_function, args, kwargs))
+
+
+runtime = WorkerRuntime()
+
+
+@worker_process_init.connect
+def start_runtime(**kwargs):
+    runtime.start()
+
+
+@worker_process_shutdown.connect
+def stop_runtime(**kwargs):
+    runtime.stop()
+
+
+def async_task(*args, **kwargs):
+    """
+    Declares Celery task from a coroutine function, the task runs it in the event loop of the worker process.
+    Accepts arguments of celery_app.task.
+    """
+    def decorator(coroutine_function):
+        @functools.wraps(coroutine_function)
+        def run(*task_args, **task_kwargs):
+            return runtime.run(coroutine_function, *task_args, **task_kwargs)
+
+        return celery_app.task(*args, **kwargs)(run)
+
+    return decorator
@@ -1,12 +1,51 @@
-import asyncio
+from controller import Currency, IdempotencyKey, Account, AccountBalance, AccountOperation
+from .runtime import async_task
 
-from controller import Currency
-from .celery import celery_app
 
-
-@celery_app.task(bind=True, name='fetch_currencies')
-def fetch_currencies(self):
+@async_task(name='fetch_currencies')
+async def fetch_currencies():
     """
     Определяет валютный курс используя для этого реальный курс валют Ценрального Банка Российской Федерации.
     """
-    asyncio.run(Currency.fetch_currencies(is_schedule_task=True))
+    await Currency.fetch_currencies()
+
+
+@async_task(name='delete_expired_idempotency_keys')
+async def delete_expired_idempotency_keys():
+    """
+    Удаляет ключи идемпотентности с истекшим сроком действия (пачками, чтобы не держать долгих блокировок).
+    """
+    return await IdempotencyKey.delete_expired()
+
+
+@async_task(name='take_balance_snapshots')
+async def take_balance_snapshots():
+    """
+    Сохраняет снимки остатков по счетам, у которых были операции после предыдущего снимка.
+    """
+    await AccountBalance.take_snapshots()
+
+
+@async_task(name='create_operation_partitions')
+async def create_operation_partitions():
+    """
+    Создает месячные секции таблицы операций на текущий и следующие месяцы (OPERATIONS_PARTITIONS_AHEAD).
+    """
+    return await AccountOperation.create_partitions()
+
+
+@async_task(name='detach_operation_partitions')
+async def detach_operation_partitions():
+    """
+    Отсоединяет секции операций старше срока хранения (OPERATIONS_RETENTION_MONTHS), данные остаются в отдельных
+    таблицах для архивирования.
+    """
+    return await AccountOperation.detach_partitions()
+
+
+@async_task(name='rollup_pending_credits')
+async def rollup_pending_credits():
+    """
+    Добавляет отложенные зачисления "горячих" счетов к их остаткам.
+    """
+    await Account.rollup_pending_credits()
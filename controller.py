@@ -1,29 +1,49 @@
+import base64
+import csv
+import hashlib
+import io
 import json
 import os
 import random
-import smtplib
 import string
+import time
 import uuid
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, date
+from decimal import Decimal, ROUND_HALF_EVEN
 
-import requests
+import httpx
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from jose import JWTError, jwt
+from sqlalchemy import DateTime, String, and_, case, cast, false, func, not_, null, or_, select, true, tuple_, \
+    union_all
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from starlette import status
 
-from db import db
-from passlib.context import CryptContext
+from cache import TTLCache
+from cbr import rates_fetcher
+from db import db, primary_reads, replica_reads
+from hashing import password_hasher
+from mailer import Outbox, outbox_sender
+from pubsub import pubsub
+from rates import CENT, RateTable
 from schema import UserCreate, UserEntry, AccountCreate, AccountEntry, CurrencyEntry, AccountOperationCreate, \
-    AccountOperationEntry, TokenData, UpdateRequestEntry
+    AccountOperationEntry, TokenData, UpdateRequestEntry, CurrencyRateEntry, AccountOperationBatchResult, \
+    AccountBalanceEntry, AccountTurnoverEntry, AccountSummaryItem, AccountsSummary, format_fio
 
-from models import users, update_requests, currencies, accounts, account_operations
+from models import UUID, Money, Rate, users, update_requests, currencies, currency_rates_history, accounts, \
+    account_operations, idempotency_keys, account_balance_snapshots, account_pending_credits
 
 
 class User:
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # Authenticated users by token subject (email)
+    cache = TTLCache(
+        maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+        ttl=float(os.environ.get('USER_CACHE_TTL', 60)))
+    cache_channel = 'user_cache_invalidation'
 
     @classmethod
-    async def get_user(cls, user_id: str = None, email: str = None, phone: str = None):
+    async def get_user(cls, user_id: uuid.UUID = None, email: str = None, phone: str = None):
         """
         Returns user data
         :param user_id: user id (optional)
@@ -37,7 +57,7 @@ class User:
         if email:
             query = query.where(users.c.email == email)
         if phone:
-            query = query.where(users.c.email == phone)
+            query = query.where(users.c.phone == phone)
 
         user = await db.fetch_one(query)
         if user:
@@ -46,29 +66,19 @@ class User:
             return None
 
     @staticmethod
-    def send_email(recipients, subject, body):
+    async def send_email(recipients, subject, body):
         """
-        Sends email via google smtp server
+        Puts email to the outbox, it is sent via smtp server by the background sender after the caller commits and
+        wakes it up
         :param recipients: email recipients
         :param subject: email title
         :param body: email body
         :return: None
         """
-        email_sender = os.environ['GOOGLE_USERNAME']
-        message = """From: %s\nTo: %s\nSubject: %s\n\n%s
-        """ % (email_sender, ", ".join(recipients), subject, body)
-        try:
-            server = smtplib.SMTP("smtp.gmail.com", 587)
-            server.ehlo()
-            server.starttls()
-            server.login(email_sender, os.environ['GOOGLE_PASSWORD'])
-            server.sendmail(email_sender, recipients, message)
-            server.close()
-            print('successfully sent the mail')
-        except:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail='Email service error')
+        if Outbox.delivery == 'direct':
+            await Outbox.send_direct(recipients=recipients, subject=subject, body=body)
+        else:
+            await Outbox.enqueue(recipients=recipients, subject=subject, body=body)
 
     @classmethod
     async def register(cls, data: UserCreate):
@@ -79,23 +89,25 @@ class User:
         """
         letters = string.ascii_lowercase + string.ascii_uppercase + string.digits
         user = UserEntry(
-            id=str(uuid.uuid4()),
+            id=uuid.uuid4(),
             first_name=data.first_name,
             last_name=data.last_name,
             middle_name=data.middle_name,
             email=data.email,
-            password=cls.pwd_context.hash(data.password),
+            password=await password_hasher.hash(data.password),
             phone=data.phone,
             confirmation_code=''.join(random.choice(letters) for _ in range(6)))
 
-        query = users.insert().values(user.dict())
-        await db.execute(query)
+        async with db.transaction():
+            query = users.insert().values(user.dict())
+            await db.execute(query)
 
-        # Send confirmation code to the user email
-        cls.send_email(
-            recipients=[user.email],
-            subject='Email confirmation',
-            body='Please confirm your email using this code: {}'.format(user.confirmation_code))
+            # Send confirmation code to the user email
+            await cls.send_email(
+                recipients=[user.email],
+                subject='Email confirmation',
+                body='Please confirm your email using this code: {}'.format(user.confirmation_code))
+        outbox_sender.wakeup()
         return user.id
 
     @classmethod
@@ -115,7 +127,7 @@ class User:
         query = users.select().where((users.c.email == username) | (users.c.phone == username))
         user = await db.fetch_one(query)
         user_data = UserEntry(**user) if user else None
-        if user_data and cls.pwd_context.verify(password, user_data.password):
+        if user_data and await password_hasher.verify(password, user_data.password):
             if not user_data.confirmation_code:
                 return user_data
             else:
@@ -137,6 +149,7 @@ class User:
         return encoded_jwt
 
     @classmethod
+    @replica_reads
     async def get_current_user(cls, token: str):
         """
         Returns data of user by access token
@@ -151,12 +164,33 @@ class User:
             token_data = TokenData(username=username)
         except JWTError:
             return None
+        # Keeps reads of the client on the primary right after its own writes
+        db.set_session(token_data.username)
+        cached_user = cls.cache.get(token_data.username)
+        if cached_user is not None:
+            return cached_user
         query = users.select().where(users.c.email == token_data.username)
         user = await db.fetch_one(query)
+        if user is None:
+            # The replica may not have received a just confirmed email yet
+            with primary_reads():
+                user = await db.fetch_one(query)
         if user is None:
             return None
         else:
-            return UserEntry(**user)
+            user_data = UserEntry(**user)
+            cls.cache.set(token_data.username, user_data)
+            return user_data
+
+    @classmethod
+    async def invalidate_cache(cls, user: UserEntry):
+        """
+        Drops cached user data in the current worker and notifies other workers
+        :param user: user data
+        :return: None
+        """
+        cls.cache.delete(user.email)
+        await pubsub.publish(cls.cache_channel, user.email)
 
     @classmethod
     async def email_confirmation(cls, confirmation_code: str):
@@ -181,16 +215,17 @@ class User:
         :param new_password: new user password
         :return: updated user id
         """
-        if not cls.pwd_context.verify(old_password, user.password):
+        if not await password_hasher.verify(old_password, user.password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail='Incorrect password',
                 headers={"WWW-Authenticate": "Bearer"})
         query = users.update(). \
             where(users.c.id == user.id). \
-            values(password=cls.pwd_context.hash(new_password)). \
+            values(password=await password_hasher.hash(new_password)). \
             returning(users.c.id)
         user_id = await db.execute(query)
+        await cls.invalidate_cache(user)
         return user_id
 
     @classmethod
@@ -202,17 +237,19 @@ class User:
         :return: None
         """
         data = UpdateRequestEntry(
-            id=str(uuid.uuid4()),
+            id=uuid.uuid4(),
             user_id=user.id,
             conditions={'email': email},
             confirmation_code=''.join(random.choice(string.digits) for _ in range(6)))
 
-        query = update_requests.insert().values(data.dict())
-        await db.execute(query)
-        cls.send_email(
-            recipients=[user.email],
-            subject='Email changing',
-            body='Please confirm your email changing using this code: {}'.format(data.confirmation_code))
+        async with db.transaction():
+            query = update_requests.insert().values(data.dict())
+            await db.execute(query)
+            await cls.send_email(
+                recipients=[user.email],
+                subject='Email changing',
+                body='Please confirm your email changing using this code: {}'.format(data.confirmation_code))
+        outbox_sender.wakeup()
 
     @classmethod
     async def update_phone(cls, user: UserEntry, phone: str):
@@ -223,17 +260,19 @@ class User:
         :return: None
         """
         data = UpdateRequestEntry(
-            id=str(uuid.uuid4()),
+            id=uuid.uuid4(),
             user_id=user.id,
             conditions={'phone': phone},
             confirmation_code=''.join(random.choice(string.digits) for _ in range(6)))
 
-        query = update_requests.insert().values(data.dict())
-        await db.execute(query)
-        cls.send_email(
-            recipients=[user.email],
-            subject='Phone changing',
-            body='Please confirm your phone changing using this code: {}'.format(data.confirmation_code))
+        async with db.transaction():
+            query = update_requests.insert().values(data.dict())
+            await db.execute(query)
+            await cls.send_email(
+                recipients=[user.email],
+                subject='Phone changing',
+                body='Please confirm your phone changing using this code: {}'.format(data.confirmation_code))
+        outbox_sender.wakeup()
 
     @classmethod
     async def confirm_update_request(cls, user: UserEntry, confirmation_code: str):
@@ -253,6 +292,7 @@ class User:
                 values(json.loads(conditions)). \
                 returning(users.c.id)
             user_id = await db.execute(query)
+            await cls.invalidate_cache(user)
             return user_id
         else:
             return None
@@ -272,10 +312,28 @@ class User:
             values(first_name=first_name, last_name=last_name, middle_name=middle_name). \
             returning(users.c.id)
         user_id = await db.execute(query)
+        await cls.invalidate_cache(user)
         return user_id
 
 
 class Account:
+    @staticmethod
+    def balance():
+        """
+        Returns balance expression of the account row: the amount plus credits pending for the rollup. Both are read
+        in one statement, so the rollup moving credits to the amount is either seen completely or not at all.
+        :return: column expression
+        """
+        pending = select(func.coalesce(func.sum(account_pending_credits.c.amount_diff), 0)).\
+            where(account_pending_credits.c.account_id == accounts.c.id).\
+            scalar_subquery()
+        return accounts.c.amount + pending
+
+    @classmethod
+    def select_with_balance(cls):
+        return select(accounts.c.id, accounts.c.user_id, accounts.c.currency_code, cls.balance().label('amount'),
+                      accounts.c.is_hot)
+
     @classmethod
     async def create(cls, data: AccountCreate, user: UserEntry):
         """
@@ -286,34 +344,35 @@ class Account:
         """
         await Currency.get_by_char_code(char_code=data.currency_code)
         account_data = AccountEntry(
-            id=str(uuid.uuid4()),
+            id=uuid.uuid4(),
             user_id=user.id,
             currency_code=data.currency_code,
             amount=data.amount)
 
-        query = accounts.select().where(accounts.c.user_id == user.id, accounts.c.currency_code == data.currency_code)
-        account = await db.fetch_one(query)
-        if not account:
-            query = accounts.insert().values(account_data.dict())
-            await db.execute(query)
-            return account_data.id
+        # One account per currency is guaranteed by the unique index on (user_id, currency_code)
+        query = insert(accounts).values(account_data.dict()).\
+            on_conflict_do_nothing(index_elements=[accounts.c.user_id, accounts.c.currency_code]).\
+            returning(accounts.c.id)
+        account_id = await db.execute(query)
+        if account_id:
+            return account_id
         else:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail='Account with the same currency already exists')
 
     @classmethod
-    async def get_by_id(cls, account_id: str, user: UserEntry = None):
+    @replica_reads
+    async def get_by_id(cls, account_id: uuid.UUID, user: UserEntry = None):
         """
         Returns bank account by account id
         :param account_id: account id
         :param user: current user data
         :return: account data
         """
+        query = cls.select_with_balance().where(accounts.c.id == account_id)
         if user:
-            query = accounts.select().where(accounts.c.id == account_id, accounts.c.user_id == user.id)
-        else:
-            query = accounts.select().where(accounts.c.id == account_id)
+            query = query.where(accounts.c.user_id == user.id)
         account = await db.fetch_one(query)
         if account:
             return AccountEntry(**account)
@@ -323,19 +382,59 @@ class Account:
                 detail='Account not found')
 
     @classmethod
+    @replica_reads
     async def get_by_user(cls, user: UserEntry):
         """
         Returns all bank accounts of the user
         :param user: current user data
-        :return: list of accounts data
+        :return: list of accounts records (fields of AccountEntry)
         """
-        query = accounts.select().where(accounts.c.user_id == user.id)
-        response = await db.fetch_all(query)
-        accounts_list = [AccountEntry(**item) for item in response]
-        return accounts_list
+        query = cls.select_with_balance().where(accounts.c.user_id == user.id)
+        return await db.fetch_all(query)
 
     @classmethod
-    async def delete(cls, account_id: str, user: UserEntry):
+    @replica_reads
+    async def get_summary(cls, user: UserEntry, currency_code: str):
+        """
+        Returns balances of all user accounts converted to one currency and their total. Accounts and the current
+        rates are read with one query, amounts are converted like transfers (cross rate, banker's rounding to cents).
+        :param user: current user data
+        :param currency_code: currency of the total
+        :return: accounts summary
+        """
+        target = currencies.alias('target')
+        query = select(accounts.c.id, accounts.c.currency_code, cls.balance().label('amount'),
+                       currencies.c.value.label('rate'), target.c.value.label('target_rate')).\
+            select_from(target.outerjoin(
+                accounts.join(currencies, accounts.c.currency_code == currencies.c.char_code),
+                accounts.c.user_id == user.id)).\
+            where(target.c.char_code == currency_code).\
+            order_by(accounts.c.currency_code)
+        rows = await db.fetch_all(query)
+        if not rows:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Currency not found')
+
+        items = []
+        for item in rows:
+            # The only row without an account is returned for users without accounts
+            if item['id'] is None:
+                continue
+            rate = item['rate'] / item['target_rate']
+            items.append(AccountSummaryItem(
+                account_id=item['id'],
+                currency_code=item['currency_code'],
+                amount=item['amount'],
+                rate=rate,
+                converted_amount=(item['amount'] * rate).quantize(CENT, rounding=ROUND_HALF_EVEN)))
+        return AccountsSummary(
+            currency_code=currency_code,
+            total=sum((item.converted_amount for item in items), Decimal('0.00')),
+            accounts=items)
+
+    @classmethod
+    async def delete(cls, account_id: uuid.UUID, user: UserEntry):
         """
         Closes bank account (full delete, archive not implemented)
         :param account_id: account id
@@ -353,108 +452,773 @@ class Account:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail='Account not found')
 
+    @classmethod
+    async def set_hot(cls, account_id: uuid.UUID, user: UserEntry, is_hot: bool):
+        """
+        Switches hot mode of the account: credits of a hot account are saved as pending and added to its amount by
+        the rollup, so concurrent transfers to it don't wait for the account row lock. Pending credits left after
+        switching the mode off are added by the next rollup.
+        :param account_id: account id
+        :param user: current user data
+        :param is_hot: hot mode
+        :return: account id
+        """
+        query = accounts.update(). \
+            where(accounts.c.id == account_id, accounts.c.user_id == user.id). \
+            values(is_hot=is_hot). \
+            returning(accounts.c.id)
+        account_id = await db.execute(query)
+        if account_id:
+            return account_id
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Account not found')
+
+    @classmethod
+    async def rollup_pending_credits(cls):
+        """
+        Adds pending credits to the account amounts and deletes them in one statement. Accounts are locked in the
+        order of ids like in AccountOperation.lock_accounts, so the rollup can't deadlock with operations.
+        :return: None
+        """
+        moved = account_pending_credits.delete().\
+            returning(account_pending_credits.c.account_id, account_pending_credits.c.amount_diff).\
+            cte('moved')
+        sums = select(moved.c.account_id, func.sum(moved.c.amount_diff).label('amount_diff')).\
+            group_by(moved.c.account_id).\
+            cte('sums')
+        locked = select(accounts.c.id).\
+            where(accounts.c.id == sums.c.account_id).\
+            order_by(accounts.c.id).\
+            with_for_update(of=accounts, key_share=True).\
+            cte('locked')
+        query = accounts.update().\
+            where(accounts.c.id == locked.c.id, accounts.c.id == sums.c.account_id).\
+            values(amount=accounts.c.amount + sums.c.amount_diff)
+        await db.execute(query)
+
 
 class AccountOperation:
+    export_chunk_size = 64 * 1024
+    # Monthly partitions are created for the current and this many next months
+    partitions_ahead = int(os.environ.get('OPERATIONS_PARTITIONS_AHEAD', 3))
+    # Partitions older than this many months are detached, 0 keeps all history
+    retention_months = int(os.environ.get('OPERATIONS_RETENTION_MONTHS', 0))
+
     @classmethod
-    async def create(cls, data: AccountOperationCreate, user: UserEntry):
+    async def lock_accounts(cls, account_ids, credited_ids=()):
         """
-        Creates bank account operation (replenish a personal account, withdraw money from a personal account, send
-        a certain amount of money to another bank user to his bank account).
+        Locks bank accounts until the end of the transaction. Rows are locked in the order of ids, so concurrent
+        operations on the same accounts can't deadlock. Hot accounts that are only credited are read without locking,
+        their credits are saved as pending (see apply).
+        :param account_ids: ids of accounts
+        :param credited_ids: ids of accounts the operations only add money to
+        :return: dict of entries like ('account_id': account data with owner fio and `locked` flag)
+        """
+        involved = accounts.c.id.in_(sorted(account_ids))
+        lock_free = and_(accounts.c.is_hot, accounts.c.id.in_(sorted(credited_ids)))
+        # Only amount changes, FOR NO KEY UPDATE doesn't block the foreign key checks (FOR KEY SHARE) of pending
+        # credits and operations inserted for a hot account meanwhile
+        locked = select(accounts).\
+            where(involved, not_(lock_free)).\
+            order_by(accounts.c.id).\
+            with_for_update(key_share=True).\
+            cte('locked_accounts')
+        rows = union_all(
+            select(locked, true().label('locked')),
+            select(accounts, false().label('locked')).where(involved, lock_free)).\
+            subquery('involved')
+        query = select(rows, users.c.first_name, users.c.last_name, users.c.middle_name).\
+            select_from(rows.join(users, rows.c.user_id == users.c.id))
+        response = await db.fetch_all(query)
+        return {item['id']: item for item in response}
+
+    @classmethod
+    async def balances(cls, locked_accounts: dict):
+        """
+        Returns current balances of the accounts, pending credits are added for locked hot accounts. They are read
+        after the lock is taken, so a rollup committed meanwhile is not counted twice.
+        :param locked_accounts: accounts returned by lock_accounts
+        :return: dict of entries like ('account_id': balance)
+        """
+        balances = {account_id: item['amount'] for account_id, item in locked_accounts.items()}
+        hot_ids = [account_id for account_id, item in locked_accounts.items() if item['is_hot'] and item['locked']]
+        if hot_ids:
+            query = select(account_pending_credits.c.account_id,
+                           func.sum(account_pending_credits.c.amount_diff).label('amount_diff')).\
+                where(account_pending_credits.c.account_id.in_(hot_ids)).\
+                group_by(account_pending_credits.c.account_id)
+            for item in await db.fetch_all(query):
+                balances[item['account_id']] += item['amount_diff']
+        return balances
+
+    @staticmethod
+    def pending_ids(locked_accounts: dict):
+        return {account_id for account_id, item in locked_accounts.items() if not item['locked']}
+
+    @staticmethod
+    def credited_ids(items):
+        """
+        Returns ids of accounts the operations only add money to (transfer recipients and deposits)
+        :param items: list of account operations data
+        :return: set of account ids
+        """
+        credited, debited = set(), set()
+        for data in items:
+            if data.recipient_account:
+                credited.add(data.recipient_account)
+                debited.add(data.account_id)
+            elif data.amount_diff > 0:
+                credited.add(data.account_id)
+            else:
+                debited.add(data.account_id)
+        return credited - debited
+
+    @classmethod
+    async def apply(cls, operations, pending_ids=()):
+        """
+        Saves operations to the ledger and updates account balances (two statements for any number of operations,
+        one more if there are pending credits)
+        :param operations: list of account operations
+        :param pending_ids: ids of unlocked hot accounts, their credits are saved as pending
+        :return: None
+        """
+        new_operations = func.unnest(
+            cast([operation.id for operation in operations], ARRAY(UUID)),
+            cast([operation.account_id for operation in operations], ARRAY(UUID)),
+            cast([operation.amount_diff for operation in operations], ARRAY(Money)),
+            cast([operation.created_at for operation in operations], ARRAY(DateTime)),
+            cast([operation.description for operation in operations], ARRAY(String))).\
+            table_valued('id', 'account_id', 'amount_diff', 'created_at', 'description').\
+            render_derived(name='new_operations')
+        query = account_operations.insert().from_select(
+            ['id', 'account_id', 'amount_diff', 'created_at', 'description'], select(new_operations))
+        await db.execute(query)
+
+        credits = [operation for operation in operations if operation.account_id in pending_ids]
+        if credits:
+            new_credits = func.unnest(
+                cast([operation.id for operation in credits], ARRAY(UUID)),
+                cast([operation.account_id for operation in credits], ARRAY(UUID)),
+                cast([operation.amount_diff for operation in credits], ARRAY(Money))).\
+                table_valued('operation_id', 'account_id', 'amount_diff').\
+                render_derived(name='new_credits')
+            query = account_pending_credits.insert().from_select(
+                ['operation_id', 'account_id', 'amount_diff'], select(new_credits))
+            await db.execute(query)
+
+        balance_diffs = {}
+        for operation in operations:
+            if operation.account_id not in pending_ids:
+                balance_diffs[operation.account_id] = balance_diffs.get(operation.account_id, 0) + \
+                    operation.amount_diff
+        if not balance_diffs:
+            return
+        diffs = func.unnest(
+            cast(list(balance_diffs.keys()), ARRAY(UUID)),
+            cast(list(balance_diffs.values()), ARRAY(Money))).\
+            table_valued('account_id', 'amount_diff').\
+            render_derived(name='diffs')
+        query = accounts.update().\
+            where(accounts.c.id == diffs.c.account_id).\
+            values(amount=accounts.c.amount + diffs.c.amount_diff)
+        await db.execute(query)
+
+    @classmethod
+    async def prepare(cls, data: AccountOperationCreate, user: UserEntry, locked_accounts: dict, balances: dict,
+                      created_at: datetime):
+        """
+        Validates operation against locked accounts and builds its ledger entries
         :param data: account operation data
         :param user: current user data
-        :return: created account operation data
+        :param locked_accounts: accounts locked by lock_accounts
+        :param balances: current balances of locked accounts, updated by the operation
+        :param created_at: operation time
+        :return: list of ledger entries, the first one belongs to the user account
         """
-        account = await Account.get_by_id(account_id=data.account_id, user=user)
+        if data.recipient_account == data.account_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Recipient account must differ from the sender account')
+        if data.recipient_account and data.amount_diff >= 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Transfer amount_diff must be negative')
+
+        account = locked_accounts.get(data.account_id)
+        if not account or account['user_id'] != user.id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Account not found')
+        # Credits can't overdraw, the balance of an unlocked hot account is read without its pending credits
+        if data.amount_diff < 0 and balances[account['id']] + data.amount_diff < 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Insufficient funds')
 
         if data.recipient_account:
-            sender_currency = await Currency.get_by_char_code(account.currency_code)
-            recipient_account = await Account.get_by_id(account_id=data.recipient_account)
-            recipient_user = await User.get_user(user_id=recipient_account.user_id)
-            recipient_currency = await Currency.get_by_char_code(char_code=recipient_account.currency_code)
-            recipient_amount_diff = -data.amount_diff * sender_currency.value / recipient_currency.value
+            recipient_account = locked_accounts.get(data.recipient_account)
+            if not recipient_account:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail='Account not found')
+            sender_currency = await Currency.get_by_char_code(account['currency_code'])
+            recipient_currency = await Currency.get_by_char_code(char_code=recipient_account['currency_code'])
+            recipient_amount_diff = Currency.rates.convert(
+                -data.amount_diff, sender_currency.char_code, recipient_currency.char_code)
 
             sender_description = 'Денежный перевод на сумму {} {}. Получатель: {}.'.\
-                format(abs(data.amount_diff), sender_currency.char_code, recipient_user.get_fio())
+                format(abs(data.amount_diff), sender_currency.char_code, format_fio(
+                    recipient_account['first_name'], recipient_account['last_name'],
+                    recipient_account['middle_name']))
             recipient_description = 'Денежный перевод на сумму {} {}. Отправитель: {}.'.\
                 format(abs(recipient_amount_diff), recipient_currency.char_code, user.get_fio())
 
-            # Sender
-            account_operation_data = AccountOperationEntry(
-                id=str(uuid.uuid4()),
-                account_id=data.account_id,
-                amount_diff=data.amount_diff,
-                created_at=datetime.utcnow(),
-                description=sender_description)
-            query = account_operations.insert().values(account_operation_data.dict())
-            await db.execute(query)
+            operations = [
+                AccountOperationEntry(
+                    id=uuid.uuid4(),
+                    account_id=data.account_id,
+                    amount_diff=data.amount_diff,
+                    created_at=created_at,
+                    description=sender_description),
+                AccountOperationEntry(
+                    id=uuid.uuid4(),
+                    account_id=data.recipient_account,
+                    amount_diff=recipient_amount_diff,
+                    created_at=created_at,
+                    description=recipient_description)]
+        else:
+            operations = [
+                AccountOperationEntry(
+                    id=uuid.uuid4(),
+                    account_id=data.account_id,
+                    amount_diff=data.amount_diff,
+                    created_at=created_at,
+                    description=data.description)]
 
-            query = accounts.update(). \
-                where(accounts.c.id == account.id). \
-                values(amount=accounts.c.amount + data.amount_diff)
-            await db.execute(query)
+        for operation in operations:
+            balances[operation.account_id] += operation.amount_diff
+        return operations
 
-            # Recipient
-            recipient_account_operation_data = AccountOperationEntry(
-                id=str(uuid.uuid4()),
-                account_id=data.recipient_account,
-                amount_diff=recipient_amount_diff,
-                created_at=datetime.utcnow(),
-                description=recipient_description)
-            query = account_operations.insert().values(recipient_account_operation_data.dict())
-            await db.execute(query)
+    @classmethod
+    async def create(cls, data: AccountOperationCreate, user: UserEntry):
+        """
+        Creates bank account operation (replenish a personal account, withdraw money from a personal account, send
+        a certain amount of money to another bank user to his bank account).
+        Balance check, ledger entries and balance updates are done in one transaction with locked accounts.
+        :param data: account operation data
+        :param user: current user data
+        :return: created account operation data
+        """
+        account_ids = {data.account_id}
+        if data.recipient_account:
+            account_ids.add(data.recipient_account)
 
-            query = accounts.update(). \
-                where(accounts.c.id == recipient_account_operation_data.account_id). \
-                values(amount=accounts.c.amount + recipient_amount_diff)
-            await db.execute(query)
+        async with db.transaction():
+            locked_accounts = await cls.lock_accounts(account_ids, cls.credited_ids([data]))
+            balances = await cls.balances(locked_accounts)
+            operations = await cls.prepare(data, user, locked_accounts, balances, created_at=datetime.utcnow())
+            await cls.apply(operations, cls.pending_ids(locked_accounts))
 
-        else:
-            account_operation_data = AccountOperationEntry(
-                id=str(uuid.uuid4()),
-                account_id=data.account_id,
-                amount_diff=data.amount_diff,
-                created_at=datetime.utcnow(),
-                description=data.description)
-            query = account_operations.insert().values(account_operation_data.dict())
-            await db.execute(query)
+        return operations[0].id
 
-            query = accounts.update().\
-                where(accounts.c.id == account.id).\
-                values(amount=accounts.c.amount + data.amount_diff)
-            await db.execute(query)
+    @classmethod
+    async def create_batch(cls, items, user: UserEntry):
+        """
+        Creates many account operations in one transaction. Operations are checked one by one in the given order,
+        failed operations are reported and skipped, the rest are applied together.
+        :param items: list of account operations data
+        :param user: current user data
+        :return: list of per item results
+        """
+        account_ids = set()
+        for data in items:
+            account_ids.add(data.account_id)
+            if data.recipient_account:
+                account_ids.add(data.recipient_account)
+
+        results = []
+        async with db.transaction():
+            locked_accounts = await cls.lock_accounts(account_ids, cls.credited_ids(items))
+            balances = await cls.balances(locked_accounts)
+            created_at = datetime.utcnow()
+            operations = []
+            for index, data in enumerate(items):
+                try:
+                    item_operations = await cls.prepare(data, user, locked_accounts, balances, created_at=created_at)
+                except HTTPException as exc:
+                    results.append(AccountOperationBatchResult(index=index, status='error', detail=exc.detail))
+                    continue
+                operations.extend(item_operations)
+                results.append(AccountOperationBatchResult(
+                    index=index, status='ok', account_operation_id=item_operations[0].id))
+            if operations:
+                await cls.apply(operations, cls.pending_ids(locked_accounts))
 
-        return account_operation_data.id
+        return results
+
+    @staticmethod
+    def encode_cursor(operation):
+        """
+        Returns pagination cursor pointing after the operation
+        :param operation: account operation data
+        :return: cursor
+        """
+        value = '{}|{}'.format(operation['created_at'].isoformat(), operation['id'])
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        """
+        Returns position encoded in the pagination cursor
+        :param cursor: cursor
+        :return: tuple of (created_at, id)
+        """
+        try:
+            created_at, operation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+            return datetime.fromisoformat(created_at), uuid.UUID(operation_id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Invalid cursor')
+
+    @classmethod
+    def split_page(cls, operations_list, limit: int):
+        """
+        Splits operations read with history_query into the page and the cursor of the next page
+        :param operations_list: operations of the page and the first operation of the next page if there is one
+        :param limit: page size
+        :return: tuple of (operations of the page, cursor of the next page or None if it is the last page)
+        """
+        if limit and len(operations_list) > limit:
+            operations_list = operations_list[:limit]
+            return operations_list, cls.encode_cursor(operations_list[-1])
+        return operations_list, None
+
+    @classmethod
+    def history_query(cls, query, limit: int = None, after: str = None, date_from: datetime = None,
+                      date_to: datetime = None):
+        """
+        Applies date filters and keyset pagination to the operations query. One more operation than the page size is
+        read, so a full last page is not taken for a page with a next one (see split_page).
+        :param query: operations query
+        :param limit: page size (optional)
+        :param after: cursor of the previous page (optional)
+        :param date_from: include operations created at or after this time (optional)
+        :param date_to: include operations created before this time (optional)
+        :return: query ordered by (created_at, id)
+        """
+        if date_from:
+            query = query.where(account_operations.c.created_at >= date_from)
+        if date_to:
+            query = query.where(account_operations.c.created_at < date_to)
+        if after:
+            after_created_at, after_id = cls.decode_cursor(after)
+            # The plain bound on created_at lets the planner skip earlier partitions, a row comparison does not
+            query = query.where(account_operations.c.created_at >= after_created_at,
+                                tuple_(account_operations.c.created_at, account_operations.c.id) >
+                                tuple_(after_created_at, after_id))
+        query = query.order_by(account_operations.c.created_at, account_operations.c.id)
+        if limit:
+            query = query.limit(limit + 1)
+        return query
 
     @classmethod
-    async def get_by_account(cls, account_id: str):
+    @replica_reads
+    async def get_by_account(cls, account_id: uuid.UUID, limit: int = None, after: str = None,
+                             date_from: datetime = None, date_to: datetime = None):
         """
-        Returns all bank account operations.
+        Returns bank account operations ordered by creation time.
         :param account_id: account id
-        :return: list of account operations
+        :param limit: page size, plus the first operation of the next page if any (optional)
+        :param after: cursor of the previous page (optional)
+        :param date_from: include operations created at or after this time (optional)
+        :param date_to: include operations created before this time (optional)
+        :return: list of account operations records (fields of AccountOperationEntry)
         """
-        query = account_operations.select().\
-            where(account_operations.c.account_id == account_id).\
-            order_by(account_operations.c.created_at)
-        response = await db.fetch_all(query)
-        account_operations_list = [AccountOperationEntry(**item) for item in response]
-        return account_operations_list
+        query = account_operations.select().where(account_operations.c.account_id == account_id)
+        query = cls.history_query(query, limit=limit, after=after, date_from=date_from, date_to=date_to)
+        return await db.fetch_all(query)
 
     @classmethod
-    async def get_by_user(cls, user: UserEntry):
+    @replica_reads
+    async def export(cls, account_id: uuid.UUID, export_format: str = 'ndjson', date_from: datetime = None,
+                     date_to: datetime = None):
+        """
+        Streams account statement from a server-side cursor, memory use does not depend on the history length
+        :param account_id: account id
+        :param export_format: 'ndjson' or 'csv'
+        :param date_from: include operations created at or after this time (optional)
+        :param date_to: include operations created before this time (optional)
+        :return: async generator of text chunks
+        """
+        query = select(account_operations.c.id, account_operations.c.created_at, account_operations.c.amount_diff,
+                       account_operations.c.description).\
+            where(account_operations.c.account_id == account_id)
+        query = cls.history_query(query, date_from=date_from, date_to=date_to)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(['id', 'created_at', 'amount_diff', 'description'])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        first_row = True
+        async for item in db.iterate(query):
+            if export_format == 'csv':
+                writer.writerow([item['id'], item['created_at'].isoformat(), item['amount_diff'], item['description']])
+            else:
+                buffer.write(json.dumps({
+                    'id': str(item['id']),
+                    'account_id': str(account_id),
+                    'amount_diff': float(item['amount_diff']),
+                    'created_at': item['created_at'].isoformat(),
+                    'description': item['description']}, ensure_ascii=False))
+                buffer.write('\n')
+            # The first row is sent at once, the rest in chunks
+            if buffer.tell() >= cls.export_chunk_size or first_row:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                first_row = False
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    @classmethod
+    @replica_reads
+    async def get_by_user(cls, user: UserEntry, limit: int = None, date_from: datetime = None,
+                          date_to: datetime = None):
         """
-        Returns all bank account operations of all user accounts.
+        Returns bank account operations of all user accounts.
         :param user: current user data
-        :return: dict of entries like ('account_id': list of account operations)
+        :param limit: page size of every account, plus the first operation of its next page if any (optional)
+        :param date_from: include operations created at or after this time (optional)
+        :param date_to: include operations created before this time (optional)
+        :return: dict of entries like ('account_id' as a string: list of account operations dicts)
         """
-        accounts_list = await Account.get_by_user(user=user)
+        # One query for all accounts: every account joins its own page of operations (LATERAL), accounts without
+        # operations in the page are kept by the outer join
+        page = cls.history_query(
+            account_operations.select().where(account_operations.c.account_id == accounts.c.id),
+            limit=limit, date_from=date_from, date_to=date_to).lateral('page')
+        query = select(accounts.c.id.label('owner_account_id'), page).\
+            select_from(accounts.outerjoin(page, true())).\
+            where(accounts.c.user_id == user.id).\
+            order_by(accounts.c.id, page.c.created_at, page.c.id)
+        rows = await db.fetch_all(query)
+
         response = {}
-        for account in accounts_list:
-            account_operations_list = await cls.get_by_account(account_id=account.id)
-            response[account.id] = account_operations_list
+        for item in rows:
+            # Keys are strings like in JSON, values are serialized as is
+            account_operations_list = response.setdefault(str(item['owner_account_id']), [])
+            if item['id'] is not None:
+                account_operations_list.append({
+                    'id': item['id'],
+                    'account_id': item['account_id'],
+                    'amount_diff': item['amount_diff'],
+                    'created_at': item['created_at'],
+                    'description': item['description']})
         return response
 
+    @staticmethod
+    def add_months(month: date, months: int):
+        """
+        Returns the first day of the month shifted by the number of months
+        :param month: any day of the month
+        :param months: number of months, negative to shift back
+        :return: date
+        """
+        index = month.year * 12 + month.month - 1 + months
+        return date(index // 12, index % 12 + 1, 1)
+
+    @staticmethod
+    def partition_name(month: date):
+        return 'account_operations_y{:04d}m{:02d}'.format(month.year, month.month)
+
+    @classmethod
+    async def create_partitions(cls):
+        """
+        Creates monthly partitions of operations for the current and next months if they don't exist yet.
+        Inserts of operations fail without a partition, so the task must run well before the last one is filled.
+        :return: list of partition names
+        """
+        month = cls.add_months(datetime.utcnow().date(), 0)
+        names = []
+        for _ in range(cls.partitions_ahead + 1):
+            next_month = cls.add_months(month, 1)
+            names.append(cls.partition_name(month))
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF account_operations FOR VALUES FROM ('{}') TO ('{}')".
+                format(cls.partition_name(month), month.isoformat(), next_month.isoformat()))
+            month = next_month
+        return names
+
+    @classmethod
+    async def detach_partitions(cls):
+        """
+        Detaches partitions of months older than the retention period. Detaching only changes the catalog, rows are
+        not deleted and the detached tables are kept for archiving. History and balances of the accounts before the
+        retention boundary are not available after that.
+        :return: list of detached partition names
+        """
+        if not cls.retention_months:
+            return []
+        boundary = cls.partition_name(cls.add_months(datetime.utcnow().date(), -cls.retention_months))
+        query = "SELECT child.relname FROM pg_inherits " \
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid " \
+                "WHERE pg_inherits.inhparent = 'account_operations'::regclass ORDER BY child.relname"
+        names = []
+        for partition in await db.fetch_all(query):
+            # Names of monthly partitions sort in time order
+            name = partition['relname']
+            if name.startswith('account_operations_y') and name < boundary:
+                await db.execute('ALTER TABLE account_operations DETACH PARTITION {}'.format(name))
+                names.append(name)
+        return names
+
+
+class AccountBalance:
+    # Operations committed later than this after their created_at would be missed by snapshots
+    snapshot_delay = int(os.environ.get('BALANCE_SNAPSHOT_DELAY', 60))
+
+    @classmethod
+    def state_query(cls, at: datetime):
+        """
+        Builds query of account state at the moment, i.e. with operations created before it (the history convention,
+        periods are [from, to)), from the nearest earlier snapshot and operations after it. Accounts without
+        snapshots are computed from the current balance and operations at or after the moment.
+        A snapshot includes operations created at or before its taken_at.
+        :param at: moment of time
+        :return: query of (account_id, amount, total_in, total_out, operations) where operations is the number of
+        operations since the snapshot
+        """
+        last = select(account_balance_snapshots).\
+            where(account_balance_snapshots.c.account_id == accounts.c.id,
+                  account_balance_snapshots.c.taken_at < at).\
+            order_by(account_balance_snapshots.c.taken_at.desc()).\
+            limit(1).\
+            lateral('last')
+        tail = select(
+            func.coalesce(func.sum(account_operations.c.amount_diff), 0).label('amount_diff'),
+            func.coalesce(func.sum(
+                case((account_operations.c.amount_diff > 0, account_operations.c.amount_diff), else_=0)),
+                0).label('total_in'),
+            func.coalesce(func.sum(
+                case((account_operations.c.amount_diff < 0, -account_operations.c.amount_diff), else_=0)),
+                0).label('total_out'),
+            func.count().label('operations')).\
+            where(account_operations.c.account_id == accounts.c.id,
+                  or_(last.c.taken_at.is_(None), account_operations.c.created_at > last.c.taken_at),
+                  account_operations.c.created_at < at).\
+            lateral('tail')
+        later = select(func.coalesce(func.sum(account_operations.c.amount_diff), 0).label('amount_diff')).\
+            where(account_operations.c.account_id == accounts.c.id,
+                  last.c.taken_at.is_(None),
+                  account_operations.c.created_at >= at).\
+            lateral('later')
+        return select(
+            accounts.c.id.label('account_id'),
+            case((last.c.taken_at.is_(None), Account.balance() - later.c.amount_diff),
+                 else_=last.c.amount + tail.c.amount_diff).label('amount'),
+            (func.coalesce(last.c.total_in, 0) + tail.c.total_in).label('total_in'),
+            (func.coalesce(last.c.total_out, 0) + tail.c.total_out).label('total_out'),
+            tail.c.operations.label('operations')).\
+            select_from(accounts.outerjoin(last, true()).join(tail, true()).join(later, true()))
+
+    @classmethod
+    async def take_snapshots(cls):
+        """
+        Saves balance snapshots of accounts that have new operations since their last snapshot
+        :return: None
+        """
+        at = datetime.utcnow() - timedelta(seconds=cls.snapshot_delay)
+        state = cls.state_query(at).subquery('state')
+        # The state includes operations created before `at`, i.e. at or before the previous microsecond
+        taken_at = at - timedelta(microseconds=1)
+        query = account_balance_snapshots.insert().from_select(
+            ['account_id', 'taken_at', 'amount', 'total_in', 'total_out'],
+            select(state.c.account_id, cast(taken_at, DateTime), state.c.amount, state.c.total_in,
+                   state.c.total_out).
+            where(state.c.operations > 0))
+        await db.execute(query)
+
+    @classmethod
+    @replica_reads
+    async def get_at(cls, account_id: uuid.UUID, at: datetime):
+        """
+        Returns account balance at the moment (operations created before it)
+        :param account_id: account id
+        :param at: moment of time
+        :return: account balance data
+        """
+        query = cls.state_query(at).where(accounts.c.id == account_id)
+        state = await db.fetch_one(query)
+        return AccountBalanceEntry(account_id=account_id, at=at, amount=state['amount'])
+
+    @classmethod
+    @replica_reads
+    async def get_turnover(cls, account_id: uuid.UUID, date_from: datetime, date_to: datetime):
+        """
+        Returns account turnover for the period (operations created at or after date_from and before date_to, like
+        the history)
+        :param account_id: account id
+        :param date_from: period start
+        :param date_to: period end
+        :return: account turnover data
+        """
+        opening = cls.state_query(date_from).where(accounts.c.id == account_id).subquery('opening')
+        closing = cls.state_query(date_to).where(accounts.c.id == account_id).subquery('closing')
+        query = select(
+            opening.c.amount.label('opening_balance'),
+            closing.c.amount.label('closing_balance'),
+            (closing.c.total_in - opening.c.total_in).label('inflow'),
+            (closing.c.total_out - opening.c.total_out).label('outflow')).\
+            select_from(opening.join(closing, true()))
+        turnover = await db.fetch_one(query)
+        return AccountTurnoverEntry(account_id=account_id, date_from=date_from, date_to=date_to, **turnover)
+
+
+class IdempotencyKey:
+    ttl = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+    # Responses of recently completed requests by (user id, key)
+    cache = TTLCache(
+        maxsize=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000)),
+        ttl=float(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400)))
+
+    @staticmethod
+    def request_hash(data):
+        """
+        Returns fingerprint of the request body
+        :param data: request data
+        :return: sha256 hex digest
+        """
+        return hashlib.sha256(data.json(sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def replay(cls, request_hash: str, stored_hash: str, response):
+        if request_hash != stored_hash:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail='Idempotency key was already used with another request')
+        return response
+
+    @classmethod
+    async def run(cls, user: UserEntry, key: str, data, action):
+        """
+        Runs the action once per idempotency key, repeated requests get the stored response. The key is saved in
+        the same transaction as the action, so a concurrent request with the same key waits for it and then
+        replays its response.
+        :param user: current user data
+        :param key: idempotency key
+        :param data: request data
+        :param action: coroutine function returning JSON serializable response
+        :return: response
+        """
+        request_hash = cls.request_hash(data)
+        cached = cls.cache.get((user.id, key))
+        if cached is not None:
+            return cls.replay(request_hash, *cached)
+
+        now = datetime.utcnow()
+        async with db.transaction():
+            query = insert(idempotency_keys).values(
+                user_id=user.id,
+                key=key,
+                request_hash=request_hash,
+                created_at=now,
+                expires_at=now + timedelta(seconds=cls.ttl))
+            # Expired key is reused as if it did not exist
+            query = query.on_conflict_do_update(
+                index_elements=[idempotency_keys.c.user_id, idempotency_keys.c.key],
+                set_={'request_hash': query.excluded.request_hash,
+                      'response': null(),
+                      'created_at': query.excluded.created_at,
+                      'expires_at': query.excluded.expires_at},
+                where=idempotency_keys.c.expires_at < now).\
+                returning(idempotency_keys.c.key)
+            if not await db.execute(query):
+                query = idempotency_keys.select().\
+                    where(idempotency_keys.c.user_id == user.id, idempotency_keys.c.key == key)
+                stored = await db.fetch_one(query)
+                response = stored['response']
+                if isinstance(response, str):
+                    response = json.loads(response)
+                cls.cache.set((user.id, key), (stored['request_hash'], response))
+                return cls.replay(request_hash, stored['request_hash'], response)
+
+            response = jsonable_encoder(await action())
+            query = idempotency_keys.update().\
+                where(idempotency_keys.c.user_id == user.id, idempotency_keys.c.key == key).\
+                values(response=response)
+            await db.execute(query)
+
+        cls.cache.set((user.id, key), (request_hash, response))
+        return response
+
+    @classmethod
+    async def delete_expired(cls, batch_size: int = 1000):
+        """
+        Deletes expired keys in batches to keep transactions short
+        :param batch_size: number of keys deleted by one statement
+        :return: number of deleted keys
+        """
+        deleted = 0
+        while True:
+            expired = select(idempotency_keys.c.user_id, idempotency_keys.c.key).\
+                where(idempotency_keys.c.expires_at < datetime.utcnow()).\
+                limit(batch_size)
+            query = idempotency_keys.delete().\
+                where(tuple_(idempotency_keys.c.user_id, idempotency_keys.c.key).in_(expired)).\
+                returning(idempotency_keys.c.key)
+            response = await db.fetch_all(query)
+            deleted += len(response)
+            if len(response) < batch_size:
+                return deleted
+
 
 class Currency:
+    # Rates of all currencies, loaded at startup and replaced on every refresh
+    rates = RateTable()
+    rates_channel = 'currency_rates'
+    # Refreshes made by other processes (the daily Celery update) are picked up after this many seconds at the latest,
+    # pubsub only makes it sooner
+    rates_ttl = float(os.environ.get('CURRENCY_RATES_TTL', 60))
+    rates_loaded_at = None
+
+    @classmethod
+    async def load_rates(cls):
+        """
+        Reloads the rate table from the database
+        :return: None
+        """
+        loaded_at = time.monotonic()
+        query = currencies.select()
+        currency = await db.fetch_all(query)
+        cls.rates = RateTable([CurrencyEntry(**item) for item in currency])
+        cls.rates_loaded_at = loaded_at
+
+    @classmethod
+    async def get_rates(cls):
+        """
+        Returns the rate table, reloaded if it is older than CURRENCY_RATES_TTL seconds
+        :return: rate table
+        """
+        if cls.rates_loaded_at is None or time.monotonic() - cls.rates_loaded_at > cls.rates_ttl:
+            await cls.load_rates()
+        return cls.rates
+
+    @classmethod
+    async def rates_changed(cls):
+        """
+        Reloads the rate table and notifies other workers to do the same
+        :return: None
+        """
+        await cls.load_rates()
+        await pubsub.publish(cls.rates_channel, '')
+
     @classmethod
     async def create(cls, char_code: str):
         """
@@ -462,16 +1226,26 @@ class Currency:
         :param char_code: currency char code
         :return: data of the created currency
         """
-        response = requests.get(os.environ['CURRENCIES_BANK_URL'])
-        json_data = response.json()
+        try:
+            json_data = await rates_fetcher.get_rates()
+        except httpx.HTTPError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Currency rates service is unavailable')
 
         if char_code in json_data['Valute'] or char_code == 'RUB':
             currency_data = CurrencyEntry(
                 char_code=char_code,
                 name='Российский рубль' if char_code == 'RUB' else json_data['Valute'][char_code]['Name'],
                 value=1. if char_code == 'RUB' else json_data['Valute'][char_code]['Value'])
-            query = currencies.insert().values(currency_data.dict())
-            await db.execute(query)
+            async with db.transaction():
+                query = currencies.insert().values(currency_data.dict())
+                await db.execute(query)
+                query = insert(currency_rates_history).\
+                    values(char_code=char_code, date=cls.document_date(json_data), value=currency_data.value).\
+                    on_conflict_do_nothing()
+                await db.execute(query)
+            await cls.rates_changed()
             return currency_data
         else:
             raise HTTPException(
@@ -481,20 +1255,24 @@ class Currency:
     @classmethod
     async def get_by_char_code(cls, char_code: str):
         """
-        Returns data of currency
+        Returns data of currency from the rate table (reloaded once if currency is not there yet or the table is
+        stale)
         :param char_code: currency char code
         :return: currency data
         """
-        query = currencies.select().where(currencies.c.char_code == char_code)
-        currency = await db.fetch_one(query)
+        currency = (await cls.get_rates()).get(char_code)
+        if currency is None:
+            await cls.load_rates()
+            currency = cls.rates.get(char_code)
         if currency:
-            return CurrencyEntry(**currency)
+            return currency
         else:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail='Currency not found')
 
     @classmethod
+    @replica_reads
     async def get_all(cls):
         """
         Returns data of all currencies
@@ -505,24 +1283,60 @@ class Currency:
         return [CurrencyEntry(**item) for item in currency]
 
     @classmethod
-    async def fetch_currencies(cls, is_schedule_task: bool = False):
+    @replica_reads
+    async def get_rate_on(cls, char_code: str, on_date: date):
         """
-        Updates currency values from outer bank
-        :return: None
+        Returns the currency rate that was actual on the date
+        :param char_code: currency char code
+        :param on_date: date
+        :return: currency rate data
         """
-        response = requests.get(os.environ['CURRENCIES_BANK_URL'])
-        json_data = response.json()
-        if is_schedule_task:
-            await db.connect()
+        query = currency_rates_history.select().\
+            where(currency_rates_history.c.char_code == char_code, currency_rates_history.c.date <= on_date).\
+            order_by(currency_rates_history.c.date.desc()).\
+            limit(1)
+        rate = await db.fetch_one(query)
+        if rate:
+            return CurrencyRateEntry(**rate)
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Currency rate not found')
 
-        currencies_list = await cls.get_all()
-        for currency in currencies_list:
-            if currency.char_code not in json_data['Valute']:
-                continue
-            currency_data = json_data['Valute'][currency.char_code]
+    @staticmethod
+    def document_date(json_data: dict):
+        """
+        Returns date of the rates document of the Central Bank
+        :param json_data: rates document
+        :return: date
+        """
+        return date.fromisoformat(json_data['Date'][:10])
+
+    @classmethod
+    async def fetch_currencies(cls):
+        """
+        Updates currency values from outer bank with one statement and saves them to the rates history
+        :return: None
+        """
+        json_data = await rates_fetcher.get_rates(force=True)
+        new_values = func.unnest(
+            cast(list(json_data['Valute'].keys()), ARRAY(String)),
+            cast([item['Value'] for item in json_data['Valute'].values()], ARRAY(Rate))).\
+            table_valued('char_code', 'value').\
+            render_derived(name='new_values')
+        rate_date = cls.document_date(json_data)
+        async with db.transaction():
             query = currencies.update().\
-                where(currencies.c.char_code == currency.char_code).\
-                values(value=currency_data['Value'])
-            await db.execute(query)
-        if is_schedule_task:
-            await db.disconnect()
+                where(currencies.c.char_code == new_values.c.char_code).\
+                values(value=new_values.c.value).\
+                returning(currencies.c.char_code, currencies.c.value)
+            updated = await db.fetch_all(query)
+            if updated:
+                query = insert(currency_rates_history).\
+                    values([{'char_code': item['char_code'], 'date': rate_date, 'value': item['value']}
+                            for item in updated])
+                query = query.on_conflict_do_update(
+                    index_elements=[currency_rates_history.c.char_code, currency_rates_history.c.date],
+                    set_={'value': query.excluded.value})
+                await db.execute(query)
+        await cls.rates_changed()
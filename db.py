@@ -1,10 +1,307 @@
+import asyncio
+import functools
+import inspect
 import os
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from databases import Database
+from databases.backends.postgres import PostgresBackend, PostgresConnection
 from dotenv import load_dotenv
+from fastapi import HTTPException
+from starlette import status
 import sqlalchemy
 
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 
-db = Database(os.environ["DATABASE_URL"])
+pool_size = Gauge('db_pool_size', 'Connections opened by the database pool', ['database'])
+pool_max_size = Gauge('db_pool_max_size', 'Maximum number of connections of the database pool', ['database'])
+pool_in_use = Gauge('db_pool_in_use', 'Database connections acquired by requests and tasks', ['database'])
+pool_idle = Gauge('db_pool_idle', 'Open database connections waiting in the pool', ['database'])
+pool_acquire_wait = Histogram('db_pool_acquire_wait_seconds', 'Time spent waiting for a free database connection',
+                              ['database'])
+pool_acquire_timeouts = Counter('db_pool_acquire_timeouts', 'Database connections not acquired within the timeout',
+                                ['database'])
+query_latency = Histogram('db_query_duration_seconds', 'Database call time by the calling method',
+                          ['caller', 'database'])
+
+# Set by the controller methods which reads may be served by the replica
+_replica_reads = ContextVar('replica_reads', default=False)
+# Client of the current request, its reads go to the primary for a while after its own writes
+_session = ContextVar('db_session', default=None)
+
+# Calling method names by code object, resolving them on every call would cost more than the timing itself
+_callers = {}
+
+
+def caller_name(frame):
+    """
+    Returns name of the function that owns the frame: Class.method for methods, module.function otherwise
+    :param frame: calling frame
+    :return: caller name
+    """
+    code = frame.f_code
+    name = _callers.get(code)
+    if name is None:
+        local_vars = frame.f_locals
+        if 'cls' in local_vars:
+            owner = local_vars['cls'].__name__
+        elif 'self' in local_vars:
+            owner = type(local_vars['self']).__name__
+        else:
+            owner = frame.f_globals.get('__name__')
+        name = _callers[code] = '{}.{}'.format(owner, code.co_name)
+    return name
+
+
+@contextmanager
+def primary_reads():
+    """
+    Sends reads inside a `replica_reads` method to the primary, e.g. to recheck a row missing on the replica
+    """
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_reads(function):
+    """
+    Marks a controller method (coroutine or async generator function) which reads may be served by the replica.
+    Reads stay on the primary inside a transaction and right after writes of the same client
+    :param function: controller method
+    :return: wrapped method
+    """
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def generator_wrapper(*args, **kwargs):
+            token = _replica_reads.set(True)
+            try:
+                async for item in function(*args, **kwargs):
+                    yield item
+            finally:
+                _replica_reads.reset(token)
+
+        return generator_wrapper
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        token = _replica_reads.set(True)
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+
+    return wrapper
+
+
+class InstrumentedPostgresConnection(PostgresConnection):
+    """
+    Backend connection that times the wait for a free pool connection and turns acquire timeouts into 503 responses
+    """
+    def __init__(self, database: 'InstrumentedPostgresBackend', dialect):
+        super().__init__(database, dialect)
+        self.instrumented = database.instrumented
+
+    async def acquire(self):
+        assert self._connection is None, 'Connection is already acquired'
+        assert self._database._pool is not None, 'DatabaseBackend is not running'
+        name = self.instrumented.name
+        started = time.perf_counter()
+        try:
+            self._connection = await self._database._pool.acquire(timeout=self.instrumented.acquire_timeout)
+        except asyncio.TimeoutError:
+            pool_acquire_timeouts.labels(name).inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Database is busy, try again later',
+                headers={'Retry-After': '1'})
+        finally:
+            pool_acquire_wait.labels(name).observe(time.perf_counter() - started)
+
+
+class InstrumentedPostgresBackend(PostgresBackend):
+    """
+    asyncpg backend of InstrumentedDatabase, hands out instrumented connections
+    """
+    def __init__(self, instrumented: 'InstrumentedDatabase', database_url, **options):
+        super().__init__(database_url, **options)
+        self.instrumented = instrumented
+
+    def connection(self):
+        return InstrumentedPostgresConnection(self, self._dialect)
+
+
+class InstrumentedDatabase(Database):
+    """
+    Database with the connection pool configured from the environment (DB_POOL_*, DB_STATEMENT_CACHE_SIZE),
+    pool metrics (acquire wait time, timeouts, connections in use and idle) and query timing by calling method.
+
+    With a replica attached, reads of the methods marked with `replica_reads` go to the replica, except for
+    transactions and clients that wrote within the last DB_REPLICA_READ_AFTER_WRITE_WINDOW seconds. Writes are
+    announced to other workers through `write_publisher` (pubsub), without it the guard holds only in the worker that
+    made the write.
+    """
+    writes_channel = 'db_writes'
+
+    def __init__(self, url: str, name: str = 'primary', replica: 'InstrumentedDatabase' = None):
+        self.name = name
+        self.replica = replica
+        # Clients with recent writes, the window must exceed the replication lag
+        self.recent_writers = TTLCache(
+            maxsize=int(os.environ.get('DB_REPLICA_WRITERS_CACHE_SIZE', 100000)),
+            ttl=float(os.environ.get('DB_REPLICA_READ_AFTER_WRITE_WINDOW', 5)))
+        # Coroutine function (channel, payload) announcing writes to other workers, e.g. pubsub.publish
+        self.write_publisher = None
+        self.min_size = int(os.environ.get('DB_POOL_MIN_SIZE', 10))
+        self.max_size = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+        self.acquire_timeout = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', 10))
+        super().__init__(
+            url,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100)),
+            max_inactive_connection_lifetime=float(os.environ.get('DB_POOL_MAX_INACTIVE_LIFETIME', 300)),
+            max_queries=int(os.environ.get('DB_POOL_MAX_QUERIES', 50000)))
+        self._backend = InstrumentedPostgresBackend(self, self.url, **self.options)
+        pool_size.labels(name).set_function(lambda: self._pool.get_size() if self._pool else 0)
+        pool_max_size.labels(name).set_function(lambda: self.max_size)
+        pool_in_use.labels(name).set_function(
+            lambda: self._pool.get_size() - self._pool.get_idle_size() if self._pool else 0)
+        pool_idle.labels(name).set_function(lambda: self._pool.get_idle_size() if self._pool else 0)
+
+    @property
+    def _pool(self):
+        return getattr(self._backend, '_pool', None)
+
+    async def connect(self):
+        if self.replica is not None:
+            await self.replica.connect()
+        if self.is_connected:
+            return
+        await super().connect()
+
+    async def disconnect(self):
+        await super().disconnect()
+        if self.replica is not None:
+            await self.replica.disconnect()
+
+    @staticmethod
+    def set_session(key):
+        """
+        Binds the current request or task to a client for the read-your-writes guard
+        :param key: client identifier, e.g. user id
+        :return: None
+        """
+        _session.set(key)
+
+    def reader(self):
+        """
+        Returns the database to serve a read of the current controller method
+        :return: replica or primary database
+        """
+        if self.replica is None or not _replica_reads.get():
+            return self
+        # A transaction must see its own writes, they are only on the primary
+        if self.connection()._transaction_stack:
+            return self
+        session = _session.get()
+        if session is not None and self.recent_writers.get(session) is not None:
+            return self
+        return self.replica
+
+    def mark_written(self, session=None):
+        """
+        Sends reads of the client to the primary for the read-after-write window
+        :param session: client identifier, the client of the current request by default
+        :return: client identifier if other workers must be told about the write, None otherwise
+        """
+        session = session or _session.get()
+        if self.replica is None or session is None:
+            return None
+        now = time.monotonic()
+        announced_at = self.recent_writers.get(session)
+        # Other workers are told at most once per half window, their marks outlive the last write by at least that
+        if announced_at is not None and now - announced_at < self.recent_writers.ttl / 2:
+            self.recent_writers.set(session, announced_at)
+            return None
+        self.recent_writers.set(session, now)
+        return session
+
+    def mark_written_elsewhere(self, session):
+        """
+        Sends reads of the client to the primary after its write announced by another worker
+        :param session: client identifier
+        :return: None
+        """
+        if self.replica is not None and session:
+            self.recent_writers.set(session, time.monotonic())
+
+    async def _announce_write(self):
+        session = self.mark_written()
+        if session is not None and self.write_publisher is not None:
+            await self.write_publisher(self.writes_channel, str(session))
+
+    async def fetch_all(self, query, values=None):
+        database = self.reader()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            return await Database.fetch_all(database, query, values)
+        finally:
+            query_latency.labels(caller, database.name).observe(time.perf_counter() - started)
+
+    async def fetch_one(self, query, values=None):
+        database = self.reader()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            return await Database.fetch_one(database, query, values)
+        finally:
+            query_latency.labels(caller, database.name).observe(time.perf_counter() - started)
+
+    async def fetch_val(self, query, values=None, column=0):
+        database = self.reader()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            return await Database.fetch_val(database, query, values, column=column)
+        finally:
+            query_latency.labels(caller, database.name).observe(time.perf_counter() - started)
+
+    async def execute(self, query, values=None):
+        await self._announce_write()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            return await super().execute(query, values)
+        finally:
+            query_latency.labels(caller, self.name).observe(time.perf_counter() - started)
+
+    async def execute_many(self, query, values):
+        await self._announce_write()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            return await super().execute_many(query, values)
+        finally:
+            query_latency.labels(caller, self.name).observe(time.perf_counter() - started)
+
+    async def iterate(self, query, values=None):
+        # Includes the time the consumer spends between rows, e.g. sending a streamed statement to the client
+        database = self.reader()
+        caller, started = caller_name(sys._getframe(1)), time.perf_counter()
+        try:
+            async for record in Database.iterate(database, query, values):
+                yield record
+        finally:
+            query_latency.labels(caller, database.name).observe(time.perf_counter() - started)
+
+
+# Optional streaming replica for reads that tolerate replication lag
+replica = InstrumentedDatabase(os.environ['DATABASE_REPLICA_URL'], name='replica') \
+    if os.environ.get('DATABASE_REPLICA_URL') else None
+db = InstrumentedDatabase(os.environ["DATABASE_URL"], replica=replica)
 metadata = sqlalchemy.MetaData()
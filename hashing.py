@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+from metrics import Counter, Gauge, Histogram
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+hasher_in_flight = Gauge('password_hasher_in_flight', 'Password hash/verify calls running or waiting in the pool')
+hasher_queue_depth = Gauge('password_hasher_queue_depth', 'Password hash/verify calls waiting for a free worker')
+hasher_rejected = Counter('password_hasher_rejected', 'Password hash/verify calls rejected because the queue is full')
+hasher_wait_time = Histogram('password_hasher_wait_seconds', 'Time spent in the pool queue', ['operation'])
+hasher_run_time = Histogram('password_hasher_run_seconds', 'Time spent hashing in the worker', ['operation'])
+
+
+def _hash(password: str):
+    started = time.time()
+    return started, pwd_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str):
+    started = time.time()
+    return started, pwd_context.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt outside of the event loop in a thread or process pool with a bounded queue
+    """
+    def __init__(self):
+        self.executor_type = os.environ.get('PASSWORD_HASHER_EXECUTOR', 'thread')
+        self.workers = int(os.environ.get('PASSWORD_HASHER_WORKERS', os.cpu_count() or 1))
+        self.queue_size = int(os.environ.get('PASSWORD_HASHER_QUEUE_SIZE', 64))
+        self.pending = 0
+        self._executor = None
+        hasher_in_flight.set_function(lambda: self.pending)
+        hasher_queue_depth.set_function(lambda: max(self.pending - self.workers, 0))
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.executor_type == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hasher')
+        return self._executor
+
+    async def _run(self, operation: str, function, *args):
+        if self.pending >= self.workers + self.queue_size:
+            hasher_rejected.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Too many authentication requests, try again later',
+                headers={'Retry-After': '1'})
+        self.pending += 1
+        submitted = time.time()
+        try:
+            started, result = await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+        hasher_wait_time.labels(operation).observe(max(started - submitted, 0.))
+        hasher_run_time.labels(operation).observe(time.time() - started)
+        return result
+
+    async def hash(self, password: str):
+        """
+        Returns bcrypt hash of the password
+        :param password: password (not hashed)
+        :return: password hash
+        """
+        return await self._run('hash', _hash, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        """
+        Checks password against the hash
+        :param password: password (not hashed)
+        :param hashed_password: password hash
+        :return: True if password matches
+        """
+        return await self._run('verify', _verify, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,339 @@
+import asyncio
+import logging
+import os
+import smtplib
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from db import db
+from metrics import Histogram
+from models import email_outbox
+
+logger = logging.getLogger(__name__)
+
+smtp_send_latency = Histogram('smtp_send_duration_seconds', 'Time spent sending one email over SMTP', ['result'])
+
+
+class SMTPConnection:
+    """
+    Persistent SMTP connection. Blocking, so it is only used from executor threads.
+    """
+    keepalive = int(os.environ.get('SMTP_KEEPALIVE', 60))
+
+    def __init__(self):
+        self.server = None
+        self.last_used = 0.
+
+    def connect(self):
+        """
+        Opens connection to the smtp server (STARTTLS and login are skipped if not configured)
+        :return: None
+        """
+        server = smtplib.SMTP(
+            os.environ.get('SMTP_HOST', 'smtp.gmail.com'),
+            int(os.environ.get('SMTP_PORT', 587)),
+            timeout=int(os.environ.get('SMTP_TIMEOUT', 30)))
+        server.ehlo()
+        if os.environ.get('SMTP_STARTTLS', '1') == '1':
+            server.starttls()
+            server.ehlo()
+        if os.environ.get('GOOGLE_PASSWORD'):
+            server.login(os.environ['GOOGLE_USERNAME'], os.environ['GOOGLE_PASSWORD'])
+        self.server = server
+
+    def close(self):
+        """
+        Closes connection, errors are ignored
+        :return: None
+        """
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            pass
+        except OSError:
+            pass
+        self.server = None
+
+    def is_alive(self):
+        """
+        Checks connection with NOOP if it was idle longer than keepalive interval
+        :return: True if connection can be reused
+        """
+        if self.server is None:
+            return False
+        if time.monotonic() - self.last_used < self.keepalive:
+            return True
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, recipients, message):
+        """
+        Sends message reconnecting once if server closed the connection
+        :param recipients: email recipients
+        :param message: raw message
+        :return: None
+        """
+        if not self.is_alive():
+            self.close()
+            self.connect()
+        try:
+            self.server.sendmail(os.environ['GOOGLE_USERNAME'], recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self.connect()
+            self.server.sendmail(os.environ['GOOGLE_USERNAME'], recipients, message)
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """
+    Fixed size pool of persistent SMTP connections
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._connections = None
+
+    async def send(self, recipients, message):
+        """
+        Sends message using a free connection of the pool
+        :param recipients: email recipients
+        :param message: raw message
+        :return: None
+        """
+        if self._connections is None:
+            self._connections = asyncio.Queue()
+            for _ in range(self.size):
+                self._connections.put_nowait(SMTPConnection())
+        connection = await self._connections.get()
+        started = time.perf_counter()
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, connection.send, recipients, message)
+        except Exception:
+            smtp_send_latency.labels('error').observe(time.perf_counter() - started)
+            # quit() waits for the server, so the connection is closed in the executor as well
+            await asyncio.get_event_loop().run_in_executor(None, connection.close)
+            raise
+        else:
+            smtp_send_latency.labels('ok').observe(time.perf_counter() - started)
+        finally:
+            self._connections.put_nowait(connection)
+
+    async def close(self):
+        """
+        Closes all connections of the pool
+        :return: None
+        """
+        if self._connections is None:
+            return
+        loop = asyncio.get_event_loop()
+        while not self._connections.empty():
+            await loop.run_in_executor(None, self._connections.get_nowait().close)
+        self._connections = None
+
+
+class Outbox:
+    # outbox: handlers only enqueue, direct: the email is sent within the request over a new connection as before the
+    # outbox (kept as the baseline of the registration benchmark)
+    delivery = os.environ.get('EMAIL_DELIVERY', 'outbox')
+    batch_size = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+    max_attempts = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+    retry_delay = int(os.environ.get('OUTBOX_RETRY_DELAY', 30))
+    max_retry_delay = int(os.environ.get('OUTBOX_MAX_RETRY_DELAY', 3600))
+    # Claimed messages are hidden from other senders for this time
+    lease = int(os.environ.get('OUTBOX_LEASE', 300))
+
+    @classmethod
+    async def enqueue(cls, recipients, subject, body):
+        """
+        Adds email to the outbox, it will be sent by the background sender. The sender can't see the message
+        before the transaction of the caller commits, so the caller wakes it up (outbox_sender.wakeup()) after that
+        :param recipients: email recipients
+        :param subject: email title
+        :param body: email body
+        :return: created message id
+        """
+        now = datetime.utcnow()
+        message_id = uuid.uuid4()
+        query = email_outbox.insert().values(
+            id=message_id,
+            recipients=recipients,
+            subject=subject,
+            body=body,
+            created_at=now,
+            attempts=0,
+            next_attempt_at=now)
+        await db.execute(query)
+        return message_id
+
+    @classmethod
+    async def send_direct(cls, recipients, subject, body):
+        """
+        Sends email right away over a new SMTP connection (EMAIL_DELIVERY=direct)
+        :param recipients: email recipients
+        :param subject: email title
+        :param body: email body
+        :return: None
+        """
+        connection = SMTPConnection()
+
+        def send():
+            try:
+                connection.send(recipients, cls.format_message(recipients, subject, body))
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, send)
+        except Exception:
+            smtp_send_latency.labels('error').observe(time.perf_counter() - started)
+            raise
+        smtp_send_latency.labels('ok').observe(time.perf_counter() - started)
+
+    @classmethod
+    async def claim_batch(cls):
+        """
+        Takes the batch of messages ready for sending, concurrent senders skip locked rows
+        :return: list of messages
+        """
+        now = datetime.utcnow()
+        ready = select(email_outbox.c.id).\
+            where(email_outbox.c.sent_at.is_(None),
+                  email_outbox.c.next_attempt_at <= now,
+                  email_outbox.c.attempts < cls.max_attempts).\
+            order_by(email_outbox.c.next_attempt_at).\
+            limit(cls.batch_size).\
+            with_for_update(skip_locked=True)
+        query = email_outbox.update().\
+            where(email_outbox.c.id.in_(ready)).\
+            values(next_attempt_at=now + timedelta(seconds=cls.lease)).\
+            returning(email_outbox.c.id, email_outbox.c.recipients, email_outbox.c.subject,
+                      email_outbox.c.body, email_outbox.c.attempts)
+        return await db.fetch_all(query)
+
+    @classmethod
+    async def mark_sent(cls, message_ids):
+        """
+        Marks messages as sent
+        :param message_ids: list of message ids
+        :return: None
+        """
+        if not message_ids:
+            return
+        query = email_outbox.update().\
+            where(email_outbox.c.id.in_(message_ids)).\
+            values(sent_at=datetime.utcnow(), attempts=email_outbox.c.attempts + 1, last_error=None)
+        await db.execute(query)
+
+    @classmethod
+    async def mark_failed(cls, message_id: uuid.UUID, attempts: int, error: str):
+        """
+        Schedules the next attempt with exponential backoff
+        :param message_id: message id
+        :param attempts: number of previous attempts
+        :param error: error description
+        :return: None
+        """
+        delay = min(cls.retry_delay * 2 ** attempts, cls.max_retry_delay)
+        query = email_outbox.update().\
+            where(email_outbox.c.id == message_id).\
+            values(attempts=attempts + 1,
+                   next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+                   last_error=error)
+        await db.execute(query)
+
+    @staticmethod
+    def format_message(recipients, subject, body):
+        """
+        Builds raw email message
+        :param recipients: email recipients
+        :param subject: email title
+        :param body: email body
+        :return: message text
+        """
+        return """From: %s\nTo: %s\nSubject: %s\n\n%s
+        """ % (os.environ['GOOGLE_USERNAME'], ", ".join(recipients), subject, body)
+
+    @classmethod
+    async def drain(cls, pool: SMTPPool):
+        """
+        Sends one batch of messages through the SMTP pool
+        :param pool: SMTP connection pool
+        :return: number of claimed messages
+        """
+        batch = await cls.claim_batch()
+
+        async def send(message):
+            await pool.send(message['recipients'],
+                            cls.format_message(message['recipients'], message['subject'], message['body']))
+
+        results = await asyncio.gather(*[send(message) for message in batch], return_exceptions=True)
+        sent = []
+        for message, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning('Email %s was not sent: %r', message['id'], result)
+                await cls.mark_failed(message['id'], message['attempts'], repr(result))
+            else:
+                sent.append(message['id'])
+        await cls.mark_sent(sent)
+        return len(batch)
+
+
+class OutboxSender:
+    """
+    Background task of the web worker that drains the outbox
+    """
+    def __init__(self):
+        self.pool = SMTPPool(size=int(os.environ.get('SMTP_POOL_SIZE', 2)))
+        self.poll_interval = float(os.environ.get('OUTBOX_POLL_INTERVAL', 5))
+        self._task = None
+        self._wakeup = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.pool.close()
+
+    def wakeup(self):
+        """
+        Starts sending immediately instead of waiting for the next poll
+        :return: None
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await Outbox.drain(self.pool)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Outbox sender failed')
+                claimed = 0
+            if claimed < Outbox.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+
+outbox_sender = OutboxSender()
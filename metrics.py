@@ -0,0 +1,201 @@
+import bisect
+import math
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class Registry:
+    """
+    Collection of process metrics rendered in Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus exposition format
+        :return: metrics text
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.family_name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.family_name, metric.type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.register(self)
+
+    @property
+    def family_name(self):
+        """
+        Name of the HELP and TYPE lines, the text format ties samples to them by this name
+        """
+        return self.name
+
+    def labels(self, *values):
+        """
+        Returns metric child for the label values
+        :param values: label values in order of labelnames
+        :return: metric child
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.create_child()
+        return child
+
+    def create_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.
+
+    def inc(self, amount: float = 1.):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    @property
+    def family_name(self):
+        # Samples are named <name>_total, in the text format 0.0.4 the family has the same name
+        return '{}_total'.format(self.name)
+
+    def create_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1.):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return ['{}{} {}'.format(self.family_name, format_labels(self.labelnames, values), format_value(child.value))
+                for values, child in self.children.items()]
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.):
+        self.value += amount
+
+    def dec(self, amount: float = 1.):
+        self.value -= amount
+
+    def set_function(self, function):
+        """
+        Gauge value will be taken from the function at render time
+        :param function: callable without arguments
+        :return: None
+        """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def create_child(self):
+        return GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1.):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def samples(self):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, values), format_value(child.get()))
+                for values, child in self.children.items()]
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def create_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        lines = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labelnames, values, ('le', format_value(bound))), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, format_labels(self.labelnames, values, ('le', '+Inf')), child.count))
+            labels = format_labels(self.labelnames, values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, format_value(child.sum)))
+            lines.append('{}_count{} {}'.format(self.name, labels, child.count))
+        return lines
@@ -1,49 +1,134 @@
+import uuid
 from datetime import datetime
 
-from sqlalchemy import Table, Column, String, ForeignKey, Integer, Float, DateTime
+from sqlalchemy import Table, Column, String, ForeignKey, Integer, Numeric, DateTime, Date, Index, Boolean, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.types import TypeDecorator
 from db import metadata
 
+
+class UUID(TypeDecorator):
+    """
+    Native uuid column with uuid.UUID values. The as_uuid mode of the dialect type expects strings from the driver and
+    fails on UUID objects returned by asyncpg, their class is not serialized by orjson either, so values are converted
+    here in both directions.
+    """
+    impl = postgresql.UUID
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else str(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or type(value) is uuid.UUID:
+            return value
+        return uuid.UUID(str(value))
+
+
+# Money amounts are exact with two decimal places, currency rates with four
+Money = Numeric(20, 2)
+Rate = Numeric(20, 4)
+
 users = Table(
     'users',
     metadata,
-    Column('id', String, primary_key=True),
+    Column('id', UUID(), primary_key=True),
     Column('first_name', String),
     Column('last_name', String),
     Column('middle_name', String),
     Column('email', String, unique=True, nullable=False),
     Column('password', String, nullable=False),
     Column('phone', String, unique=True, nullable=False),
-    Column('confirmation_code', String))
+    Column('confirmation_code', String),
+    Index('ix_users_confirmation_code', 'confirmation_code', postgresql_where=text('confirmation_code IS NOT NULL')))
 
 update_requests = Table(
     'update_requests',
     metadata,
-    Column('id', String, primary_key=True),
+    Column('id', UUID(), primary_key=True),
     Column('user_id', ForeignKey('users.id'), nullable=False),
     Column('conditions', JSON, nullable=False),
-    Column('confirmation_code', String, nullable=False))
+    Column('confirmation_code', String, nullable=False),
+    Index('ix_update_requests_user_id_confirmation_code', 'user_id', 'confirmation_code'))
 
 currencies = Table(
     'currencies',
     metadata,
     Column('char_code', String, primary_key=True),
     Column('name', String, nullable=False),
-    Column('value', Float, nullable=False))
+    Column('value', Rate, nullable=False))
+
+currency_rates_history = Table(
+    'currency_rates_history',
+    metadata,
+    Column('char_code', ForeignKey('currencies.char_code'), primary_key=True),
+    Column('date', Date, primary_key=True),
+    Column('value', Rate, nullable=False))
 
 accounts = Table(
     'accounts',
     metadata,
-    Column('id', String, primary_key=True),
+    Column('id', UUID(), primary_key=True),
     Column('user_id', ForeignKey('users.id'), nullable=False),
     Column('currency_code', ForeignKey('currencies.char_code'), nullable=False),
-    Column('amount', Float, nullable=False))
+    Column('amount', Money, nullable=False),
+    # Credits of hot accounts go to account_pending_credits instead of locking the account row
+    Column('is_hot', Boolean, default=False, nullable=False),
+    Index('ix_accounts_user_id_currency_code', 'user_id', 'currency_code', unique=True))
 
+# Partitioned by month of created_at (partitions account_operations_yYYYYmMM are created ahead by a beat task),
+# the partition key must be a part of the primary key
 account_operations = Table(
     'account_operations',
     metadata,
-    Column('id', String, primary_key=True),
+    Column('id', UUID(), primary_key=True),
+    Column('account_id', ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False),
+    Column('amount_diff', Money, nullable=False),
+    Column('created_at', DateTime, default=datetime.utcnow, primary_key=True),
+    Column('description', String),
+    Index('ix_account_operations_account_id_created_at', 'account_id', 'created_at', 'id'),
+    postgresql_partition_by='RANGE (created_at)')
+
+# Credits of hot accounts not yet added to accounts.amount, the balance is the amount plus pending credits
+account_pending_credits = Table(
+    'account_pending_credits',
+    metadata,
+    Column('operation_id', UUID(), primary_key=True),
     Column('account_id', ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False),
-    Column('amount_diff', Float, nullable=False),
+    Column('amount_diff', Money, nullable=False),
+    Index('ix_account_pending_credits_account_id', 'account_id'))
+
+email_outbox = Table(
+    'email_outbox',
+    metadata,
+    Column('id', UUID(), primary_key=True),
+    Column('recipients', JSON, nullable=False),
+    Column('subject', String, nullable=False),
+    Column('body', String, nullable=False),
     Column('created_at', DateTime, default=datetime.utcnow, nullable=False),
-    Column('description', String))
+    Column('attempts', Integer, default=0, nullable=False),
+    Column('next_attempt_at', DateTime, default=datetime.utcnow, nullable=False),
+    Column('sent_at', DateTime),
+    Column('last_error', String),
+    Index('ix_email_outbox_pending', 'next_attempt_at', postgresql_where=text('sent_at IS NULL')))
+
+idempotency_keys = Table(
+    'idempotency_keys',
+    metadata,
+    Column('user_id', ForeignKey('users.id'), primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('request_hash', String, nullable=False),
+    Column('response', JSON),
+    Column('created_at', DateTime, default=datetime.utcnow, nullable=False),
+    Column('expires_at', DateTime, nullable=False),
+    Index('ix_idempotency_keys_expires_at', 'expires_at'))
+
+account_balance_snapshots = Table(
+    'account_balance_snapshots',
+    metadata,
+    Column('account_id', ForeignKey('accounts.id', ondelete='CASCADE'), primary_key=True),
+    Column('taken_at', DateTime, primary_key=True),
+    Column('amount', Money, nullable=False),
+    Column('total_in', Money, nullable=False),
+    Column('total_out', Money, nullable=False))
@@ -0,0 +1,45 @@
+"""
+Compares two load test results saved by loadtest.py
+
+    python perf/compare.py perf/results/before.json perf/results/after.json
+"""
+import argparse
+import json
+
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return '{:+.1f}%'.format((after - before) / before * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares two load test results')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    print('before: {} {} {}'.format(before['commit'], before['started_at'], before.get('label', '')))
+    print('after:  {} {} {}'.format(after['commit'], after['started_at'], after.get('label', '')))
+    row = '{:<18} {:<8} {:>12} {:>12} {:>9}'
+    for name, result in after['scenarios'].items():
+        previous = before['scenarios'].get(name)
+        if previous is None:
+            continue
+        print('\n' + row.format(name, '', 'before', 'after', 'change'))
+        print(row.format('', 'rps', previous['rps'], result['rps'], change(previous['rps'], result['rps'])))
+        if 'operations_per_second' in previous and 'operations_per_second' in result:
+            old, new = previous['operations_per_second'], result['operations_per_second']
+            print(row.format('', 'ops/s', old, new, change(old, new)))
+        for key in ('p50', 'p95', 'p99'):
+            old, new = previous['latency_ms'][key], result['latency_ms'][key]
+            print(row.format('', key + ' ms', old, new, change(old, new)))
+        print(row.format('', 'errors', previous['errors'], result['errors'], ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,588 @@
+"""
+Load generator of the banking API.
+
+Runs scenarios one after another against a running application, each scenario for --duration seconds with
+--concurrency closed-loop workers, and reports requests/second and latency percentiles. The SMTP and Central Bank
+stubs (see stubs.py) run in the same process, the application must be started pointing to them:
+
+    SMTP_HOST=127.0.0.1 SMTP_PORT=8025 SMTP_STARTTLS=0 GOOGLE_USERNAME=bank@example.com GOOGLE_PASSWORD= \\
+    CURRENCIES_BANK_URL=http://127.0.0.1:8081/daily_json.js uvicorn view:app --port 8000
+    python perf/loadtest.py --scenarios login,transfers --concurrency 50 --duration 30
+
+Results are saved as JSON (perf/results/<time>-<commit>.json by default), compare two runs with compare.py.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import httpx
+
+PERF_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(PERF_DIR)
+
+from stubs import CURRENCIES, CBRStub, SMTPStub  # noqa: E402
+
+PASSWORD = 'LoadTest123'
+
+
+def percentile(values, q: float):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = 0
+        self.elapsed = 0.
+        self.db_calls = {}
+        self.checks = {}
+        # Successful account operations, a batch request makes many
+        self.operations = 0
+
+    def observe(self, status, latency: float):
+        self.latencies.append(latency)
+        self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'elapsed': round(self.elapsed, 3),
+            'rps': round(count / self.elapsed, 2) if self.elapsed else 0.,
+            'operations_per_second': round(self.operations / self.elapsed, 2) if self.elapsed else 0.,
+            'latency_ms': {
+                'mean': ms(sum(latencies) / count) if count else None,
+                'p50': ms(percentile(latencies, .5)),
+                'p95': ms(percentile(latencies, .95)),
+                'p99': ms(percentile(latencies, .99)),
+                'max': ms(latencies[-1]) if count else None},
+            'status_codes': self.status_codes,
+            'db_calls_per_request': {caller: round(calls / count, 3) for caller, calls in self.db_calls.items()}
+            if count else {},
+            'checks': self.checks}
+
+
+class Client:
+    """
+    Registered and confirmed user with an access token
+    """
+    def __init__(self, email: str, phone: str, token: str):
+        self.email = email
+        self.phone = phone
+        self.headers = {'Authorization': 'Bearer {}'.format(token)}
+        self.accounts = {}
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.run_id = random.randint(1000, 9999)
+        self.counter = 0
+        self.smtp = SMTPStub(port=args.smtp_port, delay=args.smtp_delay)
+        self.cbr = CBRStub(port=args.cbr_port, delay=args.cbr_delay)
+        self.http = None
+
+    def new_identity(self):
+        self.counter += 1
+        return ('lt{}-{}@example.com'.format(self.run_id, self.counter),
+                '+7{}{:06d}'.format(self.run_id, self.counter))
+
+    async def register(self, email: str, phone: str):
+        return await self.http.post('/users/', json={
+            'first_name': 'Нагрузка', 'last_name': 'Тестовая', 'email': email, 'password': PASSWORD, 'phone': phone})
+
+    async def login(self, username: str):
+        return await self.http.post('/token', data={'username': username, 'password': PASSWORD})
+
+    async def create_client(self):
+        """
+        Registers user, confirms email with the code caught by the SMTP stub and logs in
+        """
+        email, phone = self.new_identity()
+        (await self.register(email, phone)).raise_for_status()
+        code = await self.smtp.wait_code(email)
+        (await self.http.post('/users/email_confirmation/', json={'confirmation_code': code})).raise_for_status()
+        response = await self.login(email)
+        response.raise_for_status()
+        return Client(email, phone, response.json()['access_token'])
+
+    async def create_clients(self, count: int):
+        semaphore = asyncio.Semaphore(16)
+
+        async def create():
+            async with semaphore:
+                return await self.create_client()
+
+        return await asyncio.gather(*[create() for _ in range(count)])
+
+    async def open_account(self, client: Client, currency_code: str, deposit: Decimal = None):
+        response = await self.http.post('/accounts/', headers=client.headers,
+                                        json={'currency_code': currency_code, 'amount': 0})
+        response.raise_for_status()
+        account_id = client.accounts[currency_code] = response.json()['account_id']
+        if deposit:
+            await self.operation(client, account_id, deposit, raise_for_status=True)
+        return account_id
+
+    async def operation(self, client: Client, account_id: str, amount_diff: Decimal, recipient_account: str = None,
+                        raise_for_status: bool = False):
+        data = {'account_id': account_id, 'amount_diff': str(amount_diff), 'description': 'Load test'}
+        if recipient_account:
+            data['recipient_account'] = recipient_account
+        response = await self.http.post('/accounts/operations/', headers=client.headers, json=data)
+        if raise_for_status:
+            response.raise_for_status()
+        return response
+
+    async def history(self, client: Client, account_id: str):
+        """
+        Reads the whole history of the account following X-Next-Cursor
+        """
+        operations, after = [], None
+        while True:
+            params = {'account_id': account_id, 'limit': 1000}
+            if after:
+                params['after'] = after
+            response = await self.http.get('/accounts/operations/', headers=client.headers, params=params)
+            response.raise_for_status()
+            operations.extend(response.json())
+            after = response.headers.get('X-Next-Cursor')
+            if not after:
+                return operations
+
+    async def check_balances(self, clients):
+        """
+        Checks that the balance of every account of the clients equals the sum of its operations history and is not
+        negative
+        """
+        accounts_count, mismatched, negative = 0, 0, 0
+        for client in clients:
+            response = await self.http.get('/accounts/', headers=client.headers)
+            for account in response.json():
+                operations = await self.history(client, account['id'])
+                total = sum(Decimal(str(operation['amount_diff'])) for operation in operations)
+                amount = Decimal(str(account['amount']))
+                accounts_count += 1
+                if total != amount:
+                    mismatched += 1
+                if amount < 0:
+                    negative += 1
+        return {'accounts': accounts_count, 'balance_mismatches': mismatched, 'negative_balances': negative,
+                'consistent': mismatched == 0 and negative == 0}
+
+    async def db_calls(self):
+        """
+        Returns database calls by controller method (and database) from /metrics
+        """
+        response = await self.http.get('/metrics')
+        if response.status_code != 200:
+            return {}
+        calls = {}
+        for match in re.finditer(r'^db_query_duration_seconds_count\{caller="([^"]+)",database="([^"]+)"\} (\S+)$',
+                                 response.text, re.MULTILINE):
+            caller, database = match.group(1), match.group(2)
+            # Replica reads are reported separately, primary calls keep the plain method name
+            key = caller if database == 'primary' else '{} ({})'.format(caller, database)
+            calls[key] = float(match.group(3))
+        return calls
+
+    async def ensure_currencies(self):
+        for char_code in ['RUB'] + [char_code for char_code, _, _ in CURRENCIES]:
+            # Already existing currencies are rejected, that is fine
+            await self.http.post('/currencies/', json={'char_code': char_code})
+
+    async def run_scenario(self, scenario):
+        print('{}: setup'.format(scenario.name))
+        await scenario.setup()
+        result = Result(scenario.name)
+        before = await self.db_calls()
+        deadline = time.perf_counter() + self.args.duration
+
+        async def worker(index: int):
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await scenario.request(index)
+                    status = response.status_code
+                except httpx.HTTPError as error:
+                    response, status = None, type(error).__name__
+                result.observe(status, time.perf_counter() - started)
+                result.operations += scenario.operations(response)
+                await scenario.after(index, response)
+
+        print('{}: running {} workers for {}s'.format(scenario.name, self.args.concurrency, self.args.duration))
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(index) for index in range(self.args.concurrency)])
+        result.elapsed = time.perf_counter() - started
+        after = await self.db_calls()
+        result.db_calls = {caller: calls - before.get(caller, 0.) for caller, calls in after.items()
+                           if calls > before.get(caller, 0.)}
+        result.checks = await scenario.check()
+        return result
+
+    async def run(self):
+        await self.smtp.start()
+        await self.cbr.start()
+        limits = httpx.Limits(max_connections=self.args.concurrency + 16,
+                              max_keepalive_connections=self.args.concurrency + 16)
+        self.http = httpx.AsyncClient(base_url=self.args.base_url, limits=limits, timeout=self.args.timeout)
+        results = {}
+        try:
+            await self.ensure_currencies()
+            for name in self.args.scenarios:
+                result = await self.run_scenario(SCENARIOS[name](self))
+                results[name] = result.summary()
+                print_summary(name, results[name])
+            for batch_name, single_name in BATCH_BASELINES.items():
+                if batch_name in results and single_name in results:
+                    single = results[single_name]['operations_per_second']
+                    ratio = round(results[batch_name]['operations_per_second'] / single, 2) if single else None
+                    results[batch_name]['checks']['throughput_vs_{}'.format(single_name)] = ratio
+                    print('{}: {}x operations per second of {}'.format(batch_name, ratio, single_name))
+        finally:
+            await self.http.aclose()
+            await self.smtp.stop()
+            await self.cbr.stop()
+        return results
+
+
+class Scenario:
+    name = None
+
+    def __init__(self, harness: Harness):
+        self.harness = harness
+        self.args = harness.args
+
+    async def setup(self):
+        pass
+
+    async def request(self, worker: int):
+        raise NotImplementedError
+
+    async def after(self, worker: int, response):
+        """
+        Untimed follow-up of the request (cleanup)
+        """
+
+    def operations(self, response):
+        """
+        Number of account operations the request made
+        """
+        return 1 if response is not None and response.status_code < 400 else 0
+
+    async def check(self):
+        return {}
+
+
+class Registration(Scenario):
+    """
+    POST /users/ with new users. Emails go through the outbox, run with --smtp-delay to see that a slow SMTP server
+    does not change registration latency. Repeat the run against the application started with EMAIL_DELIVERY=direct
+    (the email is sent within the request) and compare p99 of both runs with compare.py.
+    """
+    name = 'registration'
+
+    async def request(self, worker: int):
+        return await self.harness.register(*self.harness.new_identity())
+
+
+class Login(Scenario):
+    """
+    POST /token, bcrypt bound. Compare runs with different PASSWORD_HASHER_WORKERS / PASSWORD_HASHER_EXECUTOR.
+    """
+    name = 'login'
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.users)
+
+    async def request(self, worker: int):
+        return await self.harness.login(random.choice(self.clients).email)
+
+
+class AccountCreation(Scenario):
+    """
+    POST /accounts/, every worker opens accounts of its own user in each currency and closes them after the request
+    """
+    name = 'account_creation'
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.concurrency)
+        self.currencies = ['RUB'] + [char_code for char_code, _, _ in CURRENCIES]
+        self.next_currency = [0] * self.args.concurrency
+
+    async def request(self, worker: int):
+        client = self.clients[worker]
+        currency_code = self.currencies[self.next_currency[worker] % len(self.currencies)]
+        self.next_currency[worker] += 1
+        return await self.harness.http.post('/accounts/', headers=client.headers,
+                                            json={'currency_code': currency_code, 'amount': 0})
+
+    async def after(self, worker: int, response):
+        if response is not None and response.status_code == 200:
+            await self.harness.http.post('/accounts/delete/', headers=self.clients[worker].headers,
+                                         params={'account_id': response.json()['account_id']})
+
+
+class Deposits(Scenario):
+    """
+    POST /accounts/operations/ depositing to the ruble accounts of --users users
+    """
+    name = 'deposits'
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.users)
+        for client in self.clients:
+            await self.harness.open_account(client, 'RUB')
+
+    async def request(self, worker: int):
+        client = self.clients[worker % len(self.clients)]
+        return await self.harness.operation(client, client.accounts['RUB'], Decimal('10.00'))
+
+
+class Transfers(Scenario):
+    """
+    Cross-currency transfers between ruble and dollar accounts of --users users (fewer users - more contention).
+    Afterwards every balance must equal the sum of its operations history and must not be negative.
+    """
+    name = 'transfers'
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.users)
+        for client in self.clients:
+            await self.harness.open_account(client, 'RUB', Decimal('1000000.00'))
+            await self.harness.open_account(client, 'USD', Decimal('10000.00'))
+
+    async def request(self, worker: int):
+        sender, recipient = random.sample(self.clients, 2)
+        source, target = random.choice([('RUB', 'USD'), ('USD', 'RUB')])
+        amount = Decimal(random.randint(100, 10000)) / 100
+        return await self.harness.operation(sender, sender.accounts[source], -amount, recipient.accounts[target])
+
+    async def check(self):
+        return await self.harness.check_balances(self.clients)
+
+
+class SingleRecipient(Scenario):
+    """
+    Transfers from --concurrency senders (one per worker, e.g. --concurrency 200) to one ruble account: every
+    transfer waits for the lock of the recipient row. Balances are checked like in transfers.
+    """
+    name = 'single_recipient'
+    hot = False
+
+    async def setup(self):
+        self.recipient = await self.harness.create_client()
+        account_id = await self.harness.open_account(self.recipient, 'RUB')
+        response = await self.harness.http.post('/accounts/hot/', headers=self.recipient.headers,
+                                                params={'account_id': account_id, 'is_hot': self.hot})
+        response.raise_for_status()
+        self.senders = await self.harness.create_clients(self.args.concurrency)
+        for sender in self.senders:
+            await self.harness.open_account(sender, 'RUB', Decimal('1000000.00'))
+
+    async def request(self, worker: int):
+        sender = self.senders[worker]
+        return await self.harness.operation(sender, sender.accounts['RUB'], Decimal('-1.00'),
+                                            self.recipient.accounts['RUB'])
+
+    async def check(self):
+        return await self.harness.check_balances([self.recipient] + self.senders)
+
+
+class HotRecipient(SingleRecipient):
+    """
+    single_recipient with the recipient account in hot mode: credits are saved as pending without locking its row
+    """
+    name = 'hot_recipient'
+    hot = True
+
+
+class BatchOperations:
+    """
+    Counts the operations of a batch response that were created
+    """
+    def operations(self, response):
+        if response is None or response.status_code >= 400:
+            return 0
+        return sum(1 for item in response.json() if item['status'] == 'ok')
+
+
+class BatchDeposits(BatchOperations, Deposits):
+    """
+    POST /accounts/operations/batch with --batch-size deposits to the ruble account of one of --users users. Run next
+    to deposits, the throughput ratio (operations per second) is reported in checks.
+    """
+    name = 'batch_deposits'
+
+    async def request(self, worker: int):
+        client = self.clients[worker % len(self.clients)]
+        items = [{'account_id': client.accounts['RUB'], 'amount_diff': '10.00', 'description': 'Load test'}
+                 for _ in range(self.args.batch_size)]
+        return await self.harness.http.post('/accounts/operations/batch', headers=client.headers,
+                                            json={'items': items})
+
+
+class BatchTransfers(BatchOperations, Transfers):
+    """
+    POST /accounts/operations/batch with --batch-size cross-currency transfers from one sender to random recipients.
+    Run next to transfers, balances are checked and the throughput ratio is reported like in batch_deposits.
+    """
+    name = 'batch_transfers'
+
+    async def request(self, worker: int):
+        sender = random.choice(self.clients)
+        items = []
+        for _ in range(self.args.batch_size):
+            recipient = random.choice([client for client in self.clients if client is not sender])
+            source, target = random.choice([('RUB', 'USD'), ('USD', 'RUB')])
+            items.append({'account_id': sender.accounts[source],
+                          'amount_diff': str(-Decimal(random.randint(100, 10000)) / 100),
+                          'recipient_account': recipient.accounts[target], 'description': 'Load test'})
+        return await self.harness.http.post('/accounts/operations/batch', headers=sender.headers,
+                                            json={'items': items})
+
+
+class History(Scenario):
+    """
+    GET /accounts/operations/ of one account, walking the pages with X-Next-Cursor
+    """
+    name = 'history'
+    limit = 100
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.users)
+        for client in self.clients:
+            await self.fill(client)
+        self.cursors = {}
+
+    async def fill(self, client: Client, currencies=('RUB',)):
+        for currency_code in currencies:
+            account_id = await self.harness.open_account(client, currency_code)
+            items = [{'account_id': account_id, 'amount_diff': '1.00', 'description': 'Load test'}
+                     for _ in range(self.args.operations)]
+            response = await self.harness.http.post('/accounts/operations/batch', headers=client.headers,
+                                                    json={'items': items})
+            response.raise_for_status()
+
+    async def request(self, worker: int):
+        client = self.clients[worker % len(self.clients)]
+        params = {'account_id': client.accounts['RUB'], 'limit': self.limit}
+        if self.cursors.get(worker):
+            params['after'] = self.cursors[worker]
+        response = await self.harness.http.get('/accounts/operations/', headers=client.headers, params=params)
+        self.cursors[worker] = response.headers.get('X-Next-Cursor')
+        return response
+
+
+class HistoryAllAccounts(History):
+    """
+    GET /accounts/operations/ without account_id for users holding an account in every currency. One database call
+    per request is expected (db_calls_per_request of AccountOperation.get_by_user) whatever the number of accounts.
+    """
+    name = 'history_all'
+    limit = 20
+
+    async def setup(self):
+        self.clients = await self.harness.create_clients(self.args.users)
+        currencies = ['RUB'] + [char_code for char_code, _, _ in CURRENCIES]
+        for client in self.clients:
+            await self.fill(client, currencies)
+
+    async def request(self, worker: int):
+        client = self.clients[worker % len(self.clients)]
+        return await self.harness.http.get('/accounts/operations/', headers=client.headers,
+                                           params={'limit': self.limit})
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (
+    Registration, Login, AccountCreation, Deposits, BatchDeposits, Transfers, BatchTransfers, SingleRecipient,
+    HotRecipient, History, HistoryAllAccounts)}
+
+# Batch scenarios and the single operation scenarios their throughput is compared with
+BATCH_BASELINES = {'batch_deposits': 'deposits', 'batch_transfers': 'transfers'}
+
+
+def print_summary(name: str, summary: dict):
+    latency = summary['latency_ms']
+    print('{}: {} requests, {} errors, {} rps, {} operations/s, p50 {} ms, p95 {} ms, p99 {} ms'.format(
+        name, summary['requests'], summary['errors'], summary['rps'], summary['operations_per_second'],
+        latency['p50'], latency['p95'], latency['p99']))
+    for caller, calls in sorted(summary['db_calls_per_request'].items()):
+        print('    {:<45} {} db calls per request'.format(caller, calls))
+    if summary['checks']:
+        print('    checks: {}'.format(json.dumps(summary['checks'])))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PERF_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the banking API')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--concurrency', type=int, default=20, help='concurrent workers')
+    parser.add_argument('--duration', type=float, default=30., help='seconds per scenario')
+    parser.add_argument('--users', type=int, default=20, help='users shared by the workers')
+    parser.add_argument('--operations', type=int, default=1000, help='history length per account')
+    parser.add_argument('--batch-size', type=int, default=100, help='operations per batch request')
+    parser.add_argument('--timeout', type=float, default=30.)
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    parser.add_argument('--smtp-delay', type=float, default=0., help='seconds the SMTP stub spends per message')
+    parser.add_argument('--cbr-port', type=int, default=8081)
+    parser.add_argument('--cbr-delay', type=float, default=0., help='seconds the CBR stub spends per request')
+    parser.add_argument('--label', default='', help='free text saved with the results, e.g. configuration')
+    parser.add_argument('--output', help='results file, perf/results/<time>-<commit>.json by default')
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+
+    started_at = datetime.now()
+    results = asyncio.get_event_loop().run_until_complete(Harness(args).run())
+    commit = git_commit()
+    output = args.output or os.path.join(
+        PERF_DIR, 'results', '{}-{}.json'.format(started_at.strftime('%Y%m%d-%H%M%S'), commit or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({
+            'started_at': started_at.isoformat(),
+            'commit': commit,
+            'label': args.label,
+            'options': {key: value for key, value in vars(args).items() if key != 'output'},
+            'scenarios': results}, file, indent=2, ensure_ascii=False)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
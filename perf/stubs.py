@@ -0,0 +1,184 @@
+"""
+Local stand-ins of the external services for load tests: SMTP server accepting all mail and the Central Bank daily
+rates document. Both run in the event loop of the load generator, point the application to them with
+
+    SMTP_HOST=127.0.0.1 SMTP_PORT=8025 SMTP_STARTTLS=0 GOOGLE_USERNAME=bank@example.com GOOGLE_PASSWORD=
+    CURRENCIES_BANK_URL=http://127.0.0.1:8081/daily_json.js
+"""
+import asyncio
+import hashlib
+import json
+import re
+from datetime import datetime
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+
+# Currency, name, rate (rubles for one unit)
+CURRENCIES = [
+    ('USD', 'Доллар США', 75.5123),
+    ('EUR', 'Евро', 82.2571),
+    ('GBP', 'Фунт стерлингов Соединенного королевства', 96.1034),
+    ('CNY', 'Китайский юань', 10.4416),
+    ('JPY', 'Японская иена', 0.5035),
+    ('CHF', 'Швейцарский франк', 84.6502),
+    ('KZT', 'Казахстанский тенге', 0.1498),
+    ('BYN', 'Белорусский рубль', 23.0147),
+    ('TRY', 'Турецкая лира', 2.2513),
+    ('INR', 'Индийская рупия', 0.8992),
+    ('AMD', 'Армянский драм', 0.1951),
+    ('UZS', 'Узбекский сум', 0.0061),
+]
+
+
+class SMTPStub:
+    """
+    Minimal SMTP server, keeps received messages in memory so the load generator can read confirmation codes
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8025, delay: float = 0.):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.messages = []
+        self.codes = {}
+        self._server = None
+        self._waiters = {}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def wait_code(self, email: str, timeout: float = 30.):
+        """
+        Returns the last confirmation code sent to the address, waits until it arrives
+        :param email: recipient address
+        :param timeout: seconds to wait
+        :return: confirmation code
+        """
+        if email not in self.codes:
+            waiter = self._waiters.setdefault(email, asyncio.Event())
+            await asyncio.wait_for(waiter.wait(), timeout)
+        return self.codes.pop(email)
+
+    def _received(self, recipients, data: str):
+        self.messages.append((recipients, data))
+        match = re.search(r'using this code: (\w+)', data)
+        if not match:
+            return
+        for email in recipients:
+            self.codes[email] = match.group(1)
+            waiter = self._waiters.pop(email, None)
+            if waiter is not None:
+                waiter.set()
+
+    async def _handle(self, reader, writer):
+        async def reply(line):
+            writer.write(line.encode() + b'\r\n')
+            await writer.drain()
+
+        recipients = []
+        await reply('220 stub ESMTP')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                verb = command[:4].upper()
+                if verb in ('HELO', 'EHLO'):
+                    await reply('250 stub')
+                elif verb == 'MAIL':
+                    recipients = []
+                    await reply('250 OK')
+                elif verb == 'RCPT':
+                    recipients.append(command[command.index(':') + 1:].strip().strip('<>'))
+                    await reply('250 OK')
+                elif verb == 'DATA':
+                    await reply('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    while True:
+                        data_line = await reader.readline()
+                        if not data_line or data_line in (b'.\r\n', b'.\n'):
+                            break
+                        lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self._received(recipients, b''.join(lines).decode(errors='replace'))
+                    await reply('250 OK')
+                elif verb == 'QUIT':
+                    await reply('221 Bye')
+                    break
+                else:
+                    await reply('250 OK')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class CBRStub:
+    """
+    Daily rates document of the Central Bank with ETag revalidation
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081, delay: float = 0.):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.requests = 0
+        self.document = json.dumps({
+            'Date': datetime.now().strftime('%Y-%m-%dT11:30:00+03:00'),
+            'Valute': {
+                char_code: {'CharCode': char_code, 'Nominal': 1, 'Name': name, 'Value': value, 'Previous': value}
+                for char_code, name, value in CURRENCIES}},
+            ensure_ascii=False)
+        self.etag = '"{}"'.format(hashlib.md5(self.document.encode()).hexdigest())
+        self._server = None
+        self._task = None
+
+    async def daily_json(self, request):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if request.headers.get('if-none-match') == self.etag:
+            return Response(status_code=304, headers={'ETag': self.etag})
+        return Response(self.document, media_type='application/json', headers={'ETag': self.etag})
+
+    async def start(self):
+        app = Starlette(routes=[Route('/daily_json.js', self.daily_json)])
+        self._server = uvicorn.Server(uvicorn.Config(app, host=self.host, port=self.port, log_level='warning'))
+        self._server.install_signal_handlers = lambda: None
+        self._task = asyncio.ensure_future(self._server.serve())
+        while not self._server.started:
+            await asyncio.sleep(.05)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            await self._task
+            self._server = None
+
+
+async def serve(smtp: SMTPStub, cbr: CBRStub):
+    await smtp.start()
+    await cbr.start()
+    print('SMTP stub on {}:{}, CBR stub on http://{}:{}/daily_json.js'.format(smtp.host, smtp.port, cbr.host, cbr.port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await smtp.stop()
+        await cbr.stop()
+
+
+if __name__ == '__main__':
+    # Stubs alone, e.g. for manual testing of the API
+    try:
+        asyncio.get_event_loop().run_until_complete(serve(SMTPStub(), CBRStub()))
+    except KeyboardInterrupt:
+        pass
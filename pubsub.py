@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+
+from db import db
+
+logger = logging.getLogger(__name__)
+
+
+class PubSub:
+    """
+    Notifications between app workers through Postgres LISTEN/NOTIFY.
+    Disabled unless PUBSUB_ENABLED=1, then every worker keeps one extra connection for listening.
+    """
+    def __init__(self):
+        self.enabled = os.environ.get('PUBSUB_ENABLED', '0') == '1'
+        self.handlers = {}
+        self._connection = None
+
+    def subscribe(self, channel: str, handler):
+        """
+        Registers channel handler, must be called before start
+        :param channel: channel name
+        :param handler: callable (or coroutine function) receiving notification payload
+        :return: None
+        """
+        self.handlers.setdefault(channel, []).append(handler)
+
+    def _dispatch(self, connection, pid, channel, payload):
+        for handler in self.handlers.get(channel, []):
+            try:
+                result = handler(payload)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logger.exception('Notification handler failed on channel %s', channel)
+
+    async def start(self):
+        if not self.enabled or self._connection is not None:
+            return
+        dsn = os.environ['DATABASE_URL'].replace('+psycopg2', '').replace('+asyncpg', '')
+        self._connection = await asyncpg.connect(dsn)
+        for channel in self.handlers:
+            await self._connection.add_listener(channel, self._dispatch)
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(self, channel: str, payload: str):
+        """
+        Sends notification to all workers (including the current one)
+        :param channel: channel name
+        :param payload: notification text
+        :return: None
+        """
+        if not self.enabled:
+            return
+        await db.execute('SELECT pg_notify(:channel, :payload)', {'channel': channel, 'payload': payload})
+
+
+pubsub = PubSub()
@@ -0,0 +1,46 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+
+CENT = Decimal('0.01')
+
+
+class RateTable:
+    """
+    Immutable snapshot of currencies with precomputed cross rates. It is never modified, a refresh replaces the
+    whole table, so readers always see a consistent rate set.
+    """
+    def __init__(self, currencies_list=()):
+        self.currencies = {currency.char_code: currency for currency in currencies_list}
+        self.cross_rates = {
+            (source.char_code, target.char_code): source.value / target.value
+            for source in self.currencies.values()
+            for target in self.currencies.values()}
+
+    def get(self, char_code: str):
+        """
+        Returns currency data
+        :param char_code: currency char code
+        :return: currency data or None if currency is unknown
+        """
+        return self.currencies.get(char_code)
+
+    def cross_rate(self, source_code: str, target_code: str):
+        """
+        Returns amount of target currency for one unit of source currency
+        :param source_code: source currency char code
+        :param target_code: target currency char code
+        :return: cross rate
+        """
+        return self.cross_rates[(source_code, target_code)]
+
+    def convert(self, amount: Decimal, source_code: str, target_code: str):
+        """
+        Converts amount between currencies, the result is rounded to cents with banker's rounding
+        :param amount: amount in source currency
+        :param source_code: source currency char code
+        :param target_code: target currency char code
+        :return: amount in target currency
+        """
+        return (amount * self.cross_rate(source_code, target_code)).quantize(CENT, rounding=ROUND_HALF_EVEN)
+
+    def __len__(self):
+        return len(self.currencies)
@@ -0,0 +1,44 @@
+import uuid
+from decimal import Decimal
+
+import orjson
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+
+def record_dict(record):
+    """
+    Returns database record as a dict. Records are not mappings since databases 0.7, values are read by key so column
+    types still convert them.
+    :param record: database record
+    :return: dict of column values
+    """
+    return {key: record[key] for key in record._mapping.keys()}
+
+
+def default(value):
+    """
+    Converts values orjson does not serialize natively, the same way as FastAPI jsonable_encoder
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        # Subclasses of uuid.UUID (asyncpg returns one for raw queries) are not serialized natively
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if hasattr(value, '_mapping'):
+        return record_dict(value)
+    raise TypeError
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson. UUID and datetime values are serialized natively, Decimal values and database
+    records through default(), so read endpoints can return query results without building Pydantic models. Dict keys
+    must be strings.
+    """
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=default)
@@ -1,10 +1,19 @@
 import re
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, date
+from decimal import Decimal
+from typing import List, Optional
+from uuid import UUID
 
 from pydantic import BaseModel, Field, validator
 
 
+def format_fio(first_name: str = None, last_name: str = None, middle_name: str = None):
+    return '{}{}{}'.format(
+        first_name,
+        ' ' + last_name if last_name else '',
+        ' ' + middle_name if middle_name else '')
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -15,7 +24,7 @@ class TokenData(BaseModel):
 
 
 class UserEntry(BaseModel):
-    id: str
+    id: UUID
     first_name: str = None
     last_name: str = None
     middle_name: str = None
@@ -25,10 +34,7 @@ class UserEntry(BaseModel):
     confirmation_code: str = None
 
     def get_fio(cls):
-        return '{}{}{}'.format(
-            cls.first_name,
-            ' ' + cls.last_name if cls.last_name else '',
-            ' ' + cls.middle_name if cls.middle_name else '')
+        return format_fio(cls.first_name, cls.last_name, cls.middle_name)
 
     class Config:
         orm_mode = True
@@ -60,7 +66,7 @@ class UserCreate(BaseModel):
 
 
 class UserResponse(BaseModel):
-    id: str
+    id: UUID
     first_name: str = Field(None, example='Ivan')
     last_name: str = Field(None, example='Ivanov')
     middle_name: str = Field(None, example='Ivanovich')
@@ -92,22 +98,22 @@ class UserUpdate(BaseModel):
 
 
 class UpdateRequestEntry(BaseModel):
-    id: str
-    user_id: str
+    id: UUID
+    user_id: UUID
     conditions: dict
     confirmation_code: str
 
 
 class AccountCreate(BaseModel):
     currency_code: str = Field(..., example='RUB')
-    amount: float = Field(..., example='10000000.00')
+    amount: Decimal = Field(..., example='10000000.00', max_digits=20, decimal_places=2)
 
     @validator('amount')
     def check_amount(cls, amount):
         """
         Счёт нельзя создать с отрицательным балансом
         """
-        if amount < 0.:
+        if amount < 0:
             raise ValueError('Amount must be positive')
         return amount
 
@@ -116,9 +122,9 @@ class AccountCreate(BaseModel):
 
 
 class AccountOperationEntry(BaseModel):
-    id: str
-    account_id: str
-    amount_diff: float
+    id: UUID
+    account_id: UUID
+    amount_diff: Decimal
     created_at: datetime
     description: str = None
 
@@ -127,29 +133,104 @@ class AccountOperationEntry(BaseModel):
 
 
 class AccountOperationCreate(BaseModel):
-    account_id: str = Field(..., example='66a5eabf-e55f-46b9-b6c7-bf01bc998ca3')
-    amount_diff: float = Field(..., example='-100000.00')
+    account_id: UUID = Field(..., example='66a5eabf-e55f-46b9-b6c7-bf01bc998ca3')
+    amount_diff: Decimal = Field(..., example='-100000.00', max_digits=20, decimal_places=2)
     description: str = Field(..., example='Снятие наличных')
-    recipient_account: str = Field(None, example='96a02225-c216-451b-8e9f-d8d4df452296')
+    recipient_account: UUID = Field(None, example='96a02225-c216-451b-8e9f-d8d4df452296')
 
     class Config:
         orm_mode = True
 
 
+class AccountOperationBatch(BaseModel):
+    items: List[AccountOperationCreate] = Field(..., min_items=1, max_items=10000)
+
+
+class AccountOperationBatchResult(BaseModel):
+    index: int
+    status: str = Field(..., example='ok')
+    account_operation_id: UUID = None
+    detail: str = None
+
+
 class AccountEntry(BaseModel):
-    id: str
-    user_id: str
+    id: UUID
+    user_id: UUID
     currency_code: str
-    amount: float
+    amount: Decimal
+    is_hot: bool = False
 
     class Config:
         orm_mode = True
 
 
+class AccountSummaryItem(BaseModel):
+    account_id: UUID
+    currency_code: str
+    amount: Decimal
+    rate: Decimal
+    converted_amount: Decimal
+
+
+class AccountsSummary(BaseModel):
+    currency_code: str
+    total: Decimal
+    accounts: List[AccountSummaryItem]
+
+
+class AccountBalanceEntry(BaseModel):
+    account_id: UUID
+    at: datetime
+    amount: Decimal
+
+
+class AccountTurnoverEntry(BaseModel):
+    account_id: UUID
+    date_from: datetime
+    date_to: datetime
+    opening_balance: Decimal
+    closing_balance: Decimal
+    inflow: Decimal
+    outflow: Decimal
+
+
+class AccountAnalyticsDay(BaseModel):
+    date: date
+    operations: int
+    inflow: Decimal
+    outflow: Decimal
+    closing_balance: Decimal
+    min_balance: Decimal
+    max_balance: Decimal
+
+
+class AccountAnalyticsEntry(BaseModel):
+    account_id: UUID
+    date_from: datetime
+    date_to: datetime
+    opening_balance: Decimal
+    closing_balance: Decimal
+    inflow: Decimal
+    outflow: Decimal
+    min_balance: Decimal
+    max_balance: Decimal
+    operations: int
+    days: List[AccountAnalyticsDay]
+
+
 class CurrencyEntry(BaseModel):
     char_code: str
     name: str
-    value: float
+    value: Decimal
+
+    class Config:
+        orm_mode = True
+
+
+class CurrencyRateEntry(BaseModel):
+    char_code: str
+    date: date
+    value: Decimal
 
     class Config:
         orm_mode = True
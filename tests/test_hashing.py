@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from hashing import PasswordHasher, hasher_rejected
+
+
+def wait_for(event: threading.Event):
+    # Stands for a slow bcrypt call, returns like the pool functions
+    started = time.time()
+    event.wait(10)
+    return started, None
+
+
+def test_queue_is_bounded(monkeypatch):
+    monkeypatch.setenv('PASSWORD_HASHER_WORKERS', '1')
+    monkeypatch.setenv('PASSWORD_HASHER_QUEUE_SIZE', '2')
+    hasher = PasswordHasher()
+    release = threading.Event()
+
+    async def run():
+        # One call runs in the worker, two wait in the queue
+        accepted = [asyncio.ensure_future(hasher._run('hash', wait_for, release)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert hasher.pending == 3
+
+        rejected = hasher_rejected.labels().value
+        with pytest.raises(HTTPException) as error:
+            await hasher._run('hash', wait_for, release)
+        assert error.value.status_code == 503
+        assert error.value.headers == {'Retry-After': '1'}
+        assert hasher_rejected.labels().value == rejected + 1
+        assert hasher.pending == 3
+
+        release.set()
+        await asyncio.gather(*accepted)
+        assert hasher.pending == 0
+        # Finished calls free their slots
+        hashed = await hasher.hash('secret')
+        assert await hasher.verify('secret', hashed)
+        assert not await hasher.verify('wrong', hashed)
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        hasher.shutdown()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import smtplib
+from datetime import datetime
+
+import pytest
+
+from db import db
+from mailer import Outbox
+from models import email_outbox
+
+needs_database = pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+
+
+class FakePool:
+    """
+    SMTP pool that fails every message with the given error or keeps sent messages
+    """
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.sent = []
+
+    async def send(self, recipients, message):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((recipients, message))
+
+
+def run_rolled_back(test):
+    """
+    Runs the coroutine function in a transaction that is rolled back, so other outbox rows do not affect it
+    """
+    async def run():
+        await db.connect()
+        try:
+            async with db.transaction(force_rollback=True):
+                await test()
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
+
+
+async def get_message(message_id):
+    return await db.fetch_one(email_outbox.select().where(email_outbox.c.id == message_id))
+
+
+async def make_ready(message_id):
+    await db.execute(email_outbox.update().where(email_outbox.c.id == message_id).
+                     values(next_attempt_at=datetime.utcnow()))
+
+
+@needs_database
+def test_failed_email_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setenv('GOOGLE_USERNAME', 'bank@example.com')
+
+    async def test():
+        message_id = await Outbox.enqueue(['user@example.com'], 'Email confirmation', 'Code: 123456')
+        for attempt in range(2):
+            failed_at = datetime.utcnow()
+            assert await Outbox.drain(FakePool(smtplib.SMTPServerDisconnected('Connection unexpectedly closed')))
+            message = await get_message(message_id)
+            assert message['attempts'] == attempt + 1
+            assert message['sent_at'] is None
+            assert 'Connection unexpectedly closed' in message['last_error']
+            # The delay doubles with every failed attempt
+            delay = (message['next_attempt_at'] - failed_at).total_seconds()
+            assert Outbox.retry_delay * 2 ** attempt <= delay < Outbox.retry_delay * 2 ** attempt + 5
+            # The message is not claimed again before its next attempt
+            assert message_id not in [claimed['id'] for claimed in await Outbox.claim_batch()]
+            await make_ready(message_id)
+
+        pool = FakePool()
+        await Outbox.drain(pool)
+        message = await get_message(message_id)
+        assert message['sent_at'] is not None
+        assert message['attempts'] == 3
+        assert message['last_error'] is None
+        assert [sent for recipients, sent in pool.sent if 'Code: 123456' in sent]
+
+    run_rolled_back(test)
+
+
+@needs_database
+def test_backoff_is_capped_and_attempts_are_limited():
+    async def test():
+        message_id = await Outbox.enqueue(['user@example.com'], 'Subject', 'Body')
+        failed_at = datetime.utcnow()
+        await Outbox.mark_failed(message_id, 20, 'Error')
+        message = await get_message(message_id)
+        delay = (message['next_attempt_at'] - failed_at).total_seconds()
+        assert Outbox.max_retry_delay <= delay < Outbox.max_retry_delay + 5
+
+        await db.execute(email_outbox.update().where(email_outbox.c.id == message_id).
+                         values(attempts=Outbox.max_attempts, next_attempt_at=datetime.utcnow()))
+        assert message_id not in [claimed['id'] for claimed in await Outbox.claim_batch()]
+
+    run_rolled_back(test)
@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import json
+import os
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+
+needs_database = pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+
+
+@needs_database
+def test_concurrent_transfers_keep_balances_consistent(create_user):
+    from sqlalchemy import func, select
+
+    from app import shutdown, startup
+    from controller import Account, AccountOperation
+    from db import db
+    from models import account_operations
+    from schema import AccountOperationCreate
+
+    async def get_balance(account_id):
+        return (await Account.get_by_id(account_id)).amount
+
+    async def get_ledger_sum(account_id):
+        query = select(func.coalesce(func.sum(account_operations.c.amount_diff), 0)).\
+            where(account_operations.c.account_id == account_id)
+        return await db.fetch_val(query)
+
+    async def run():
+        # databases keeps the connection of a task in a context variable, transfers started from the context taken
+        # before any query get own connections like separate requests
+        request_context = contextvars.copy_context()
+
+        def spawn(coroutine):
+            return request_context.run(asyncio.ensure_future, coroutine)
+
+        await startup()
+        try:
+            sender, sender_ids = await create_user(RUB='0.00')
+            recipient, recipient_ids = await create_user(RUB='0.00')
+            # Credits of a hot account are saved as pending and moved to its amount by the rollup
+            await Account.set_hot(recipient_ids['RUB'], recipient, True)
+
+            deposited = Decimal('0.00')
+            for attempt in range(5):
+                # Deposits cover only a few transfers, so the balance checks race for the last money
+                for user, account_id, amount in ((sender, sender_ids['RUB'], '100.00'),
+                                                 (recipient, recipient_ids['RUB'], '10.00')):
+                    await AccountOperation.create(AccountOperationCreate(
+                        account_id=account_id, amount_diff=amount, description='Пополнение'), user)
+                    deposited += Decimal(amount)
+
+                transfers = []
+                for index in range(30):
+                    transfers.append(spawn(AccountOperation.create(AccountOperationCreate(
+                        account_id=sender_ids['RUB'], recipient_account=recipient_ids['RUB'],
+                        amount_diff='-30.00', description='Перевод'), sender)))
+                    transfers.append(spawn(AccountOperation.create(AccountOperationCreate(
+                        account_id=recipient_ids['RUB'], recipient_account=sender_ids['RUB'],
+                        amount_diff='-7.15', description='Перевод'), recipient)))
+                    if index % 10 == 0:
+                        transfers.append(spawn(Account.rollup_pending_credits()))
+                results = await asyncio.gather(*transfers, return_exceptions=True)
+
+                failed = [result for result in results if isinstance(result, BaseException)]
+                for error in failed:
+                    assert isinstance(error, HTTPException) and error.detail == 'Insufficient funds', repr(error)
+                assert failed and len(failed) < len(results)
+
+                balances = {account_id: await get_balance(account_id)
+                            for account_id in (sender_ids['RUB'], recipient_ids['RUB'])}
+                assert sum(balances.values()) == deposited
+                for account_id, balance in balances.items():
+                    assert balance >= 0
+                    # Pending credits of the hot account are in the ledger before the rollup
+                    assert balance == await get_ledger_sum(account_id)
+        finally:
+            await shutdown()
+
+    asyncio.run(run())
+
+
+@needs_database
+def test_operations_of_all_accounts_are_loaded_in_one_query(create_user, monkeypatch):
+    from app import shutdown, startup
+    from controller import AccountOperation
+    from db import db
+    from schema import AccountOperationCreate
+
+    queries = []
+
+    def count(method):
+        async def counted(*args, **kwargs):
+            queries.append(args[0])
+            return await method(*args, **kwargs)
+        return counted
+
+    async def run():
+        await startup()
+        try:
+            user, account_ids = await create_user(RUB='0.00', USD='0.00', EUR='0.00')
+            other_user, other_account_ids = await create_user(RUB='0.00')
+            for account_id, amounts in ((account_ids['RUB'], ('10.00', '-2.50', '7.00')),
+                                        (account_ids['USD'], ('1.00',)),
+                                        (other_account_ids['RUB'], ('5.00',))):
+                owner = other_user if account_id == other_account_ids['RUB'] else user
+                for amount in amounts:
+                    await AccountOperation.create(AccountOperationCreate(
+                        account_id=account_id, amount_diff=amount, description='Пополнение'), owner)
+
+            for method in ('fetch_all', 'fetch_one', 'fetch_val', 'execute'):
+                monkeypatch.setattr(db, method, count(getattr(db, method)))
+            operations = await AccountOperation.get_by_user(user)
+            assert len(queries) == 1
+
+            # Accounts without operations are included with an empty list
+            assert set(operations) == {str(account_id) for account_id in account_ids.values()}
+            assert operations[str(account_ids['EUR'])] == []
+            assert [item['amount_diff'] for item in operations[str(account_ids['RUB'])]] == \
+                [Decimal('10.00'), Decimal('-2.50'), Decimal('7.00')]
+            assert [item['amount_diff'] for item in operations[str(account_ids['USD'])]] == [Decimal('1.00')]
+            for account_id in account_ids.values():
+                assert all(item['account_id'] == account_id for item in operations[str(account_id)])
+
+            # Pages are taken per account in the same query, with the first operation of the next page if any
+            operations = await AccountOperation.get_by_user(user, limit=2)
+            assert len(queries) == 2
+            assert [item['amount_diff'] for item in operations[str(account_ids['RUB'])]] == \
+                [Decimal('10.00'), Decimal('-2.50'), Decimal('7.00')]
+            assert [item['amount_diff'] for item in operations[str(account_ids['USD'])]] == [Decimal('1.00')]
+        finally:
+            await shutdown()
+
+    asyncio.run(run())
+
+
+@needs_database
+def test_next_cursor_is_returned_only_if_there_is_a_next_page(create_user):
+    import httpx
+
+    import view
+    from app import shutdown, startup
+    from controller import AccountOperation, User
+    from schema import AccountOperationCreate
+
+    async def run():
+        await startup()
+        try:
+            user, account_ids = await create_user(RUB='0.00', USD='0.00')
+            for account_id, count in ((account_ids['RUB'], 5), (account_ids['USD'], 2)):
+                for index in range(count):
+                    await AccountOperation.create(AccountOperationCreate(
+                        account_id=account_id, amount_diff='{}.00'.format(index + 1), description='Пополнение'), user)
+
+            headers = {'Authorization': 'Bearer {}'.format(User.create_access_token(user.email))}
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=view.app), base_url='http://test') as client:
+                async def get(**params):
+                    response = await client.get('/accounts/operations/', params=params, headers=headers)
+                    assert response.status_code == 200
+                    return response
+
+                # Without limit the whole history is returned
+                response = await get(account_id=str(account_ids['RUB']))
+                assert len(response.json()) == 5
+                assert 'X-Next-Cursor' not in response.headers
+
+                pages, after = [], None
+                while True:
+                    params = {'account_id': str(account_ids['RUB']), 'limit': 2}
+                    if after:
+                        params['after'] = after
+                    response = await get(**params)
+                    pages.append([item['amount_diff'] for item in response.json()])
+                    after = response.headers.get('X-Next-Cursor')
+                    if not after:
+                        break
+                assert pages == [[1.0, 2.0], [3.0, 4.0], [5.0]]
+
+                # A full page without more operations is the last one
+                response = await get(account_id=str(account_ids['USD']), limit=2)
+                assert len(response.json()) == 2
+                assert 'X-Next-Cursor' not in response.headers
+
+                response = await get(limit=2)
+                operations = response.json()
+                assert [len(operations[str(account_ids[code])]) for code in ('RUB', 'USD')] == [2, 2]
+                next_cursors = json.loads(response.headers['X-Next-Cursors'])
+                assert list(next_cursors) == [str(account_ids['RUB'])]
+                response = await get(account_id=str(account_ids['RUB']), limit=2,
+                                     after=next_cursors[str(account_ids['RUB'])])
+                assert [item['amount_diff'] for item in response.json()] == [3.0, 4.0]
+        finally:
+            await shutdown()
+
+    asyncio.run(run())
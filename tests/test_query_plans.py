@@ -0,0 +1,284 @@
+"""
+Query plan regression check.
+
+Seeds the scratch database with a realistic amount of data (once, QUERY_PLANS_USERS clients), runs the controller
+methods against it, captures every statement they send to the database and checks its EXPLAIN plan. The test fails if
+a statement reads one of the large tables with a sequential scan, so a missing or unusable index is found before it
+reaches production. Every statement of the scenario is rolled back.
+"""
+import asyncio
+import os
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, event, text
+
+needs_database = pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+
+# Tables that grow with the number of clients, a sequential scan of them is a regression
+LARGE_TABLES = {'users', 'update_requests', 'accounts', 'account_operations', 'email_outbox', 'idempotency_keys',
+                'account_balance_snapshots', 'currency_rates_history'}
+
+# Partitions are reported as their partitioned table
+PARTITION_SUFFIX = re.compile(r'_y\d{4}m\d{2}$')
+
+# Partitions without rows (the months ahead), the planner scans them sequentially whatever the indexes are
+EMPTY_PARTITIONS = text("""
+    SELECT partition.relname FROM pg_inherits
+    JOIN pg_class partition ON partition.oid = pg_inherits.inhrelid
+    WHERE partition.relkind = 'r' AND partition.reltuples <= 0""")
+
+# Statements that process whole tables by design
+FULL_SCANS_ALLOWED = {
+    'AccountBalance.take_snapshots': {'accounts'},
+}
+
+
+class QueryRecorder:
+    """
+    Wraps the database methods and records statements together with the controller method that sent them
+    """
+    methods = ('fetch_all', 'fetch_one', 'fetch_val', 'execute', 'iterate')
+
+    def __init__(self, database):
+        self.database = database
+        self.statements = []
+
+    def install(self, monkeypatch):
+        for name in self.methods:
+            monkeypatch.setattr(self.database, name, self.wrap(getattr(self.database, name)))
+
+    def wrap(self, method):
+        def wrapper(query, values=None, *args, **kwargs):
+            self.record(query, values, sys._getframe(1))
+            return method(query, values, *args, **kwargs)
+        return wrapper
+
+    def record(self, query, values, frame):
+        if isinstance(query, str):
+            query = text(query).bindparams(**(values or {}))
+        owner = frame.f_locals.get('cls')
+        if owner is not None:
+            caller = '{}.{}'.format(owner.__name__, frame.f_code.co_name)
+        else:
+            caller = '{}.{}'.format(frame.f_globals.get('__name__'), frame.f_code.co_name)
+        self.statements.append((caller, query))
+
+
+def explain(connection, statement):
+    """
+    Returns EXPLAIN (FORMAT JSON) of the statement. The statement is executed as usual with EXPLAIN prepended to the
+    SQL sent to the driver, so binds are processed by the statement types and DML statements are not run.
+    """
+    plans = []
+
+    def before_cursor_execute(conn, cursor, sql, parameters, context, executemany):
+        return 'EXPLAIN (FORMAT JSON) {}'.format(sql), parameters
+
+    def after_cursor_execute(conn, cursor, sql, parameters, context, executemany):
+        # Read before the result is processed as the result of the original statement
+        plans.append(cursor.fetchone()[0])
+
+    event.listen(connection, 'before_cursor_execute', before_cursor_execute, retval=True)
+    event.listen(connection, 'after_cursor_execute', after_cursor_execute)
+    try:
+        connection.execute(statement)
+    finally:
+        event.remove(connection, 'before_cursor_execute', before_cursor_execute)
+        event.remove(connection, 'after_cursor_execute', after_cursor_execute)
+    return plans[0]
+
+
+def seq_scans(plan, empty_partitions=frozenset()):
+    """
+    Returns relations read by sequential scans in the plan tree
+    :param plan: plan node of EXPLAIN (FORMAT JSON)
+    :param empty_partitions: names of partitions without rows, their scans are skipped
+    :return: list of relation names
+    """
+    relations = []
+    if plan.get('Node Type') == 'Seq Scan' and plan['Relation Name'] not in empty_partitions:
+        relations.append(PARTITION_SUFFIX.sub('', plan['Relation Name']))
+    for child in plan.get('Plans', []):
+        relations.extend(seq_scans(child, empty_partitions))
+    return relations
+
+
+def seed(engine, users_count: int, operations_per_account: int):
+    """
+    Fills the database with generated clients, accounts and history unless it is already seeded
+    """
+    with engine.begin() as connection:
+        if connection.execute(text("SELECT 1 FROM users WHERE email = 'user1@example.com'")).scalar():
+            return
+        params = {'users': users_count, 'operations': operations_per_account}
+        connection.execute(text("""
+            INSERT INTO currencies (char_code, name, value) VALUES
+                ('RUB', 'Российский рубль', 1), ('USD', 'Доллар США', 75.5), ('EUR', 'Евро', 82.25)
+            ON CONFLICT DO NOTHING"""))
+        connection.execute(text("""
+            INSERT INTO users (id, first_name, last_name, email, password, phone, confirmation_code)
+            SELECT md5('user' || i)::uuid, 'Иван', 'Иванов', 'user' || i || '@example.com', 'not a hash',
+                   '+7' || lpad(i::text, 10, '0'), CASE WHEN i % 10 = 0 THEN substr(md5(i::text), 1, 6) END
+            FROM generate_series(1, :users) i"""), params)
+        connection.execute(text("""
+            INSERT INTO update_requests (id, user_id, conditions, confirmation_code)
+            SELECT md5('request' || i)::uuid, md5('user' || i)::uuid, '{"phone": "+70000000000"}',
+                   lpad((i % 1000000)::text, 6, '0')
+            FROM generate_series(1, :users, 5) i"""), params)
+        connection.execute(text("""
+            INSERT INTO accounts (id, user_id, currency_code, amount)
+            SELECT md5('account' || i || code)::uuid, md5('user' || i)::uuid, code, 1000000
+            FROM generate_series(1, :users) i, unnest(ARRAY['RUB', 'USD']) code"""), params)
+        # Partitions of the months covered by the generated history, the migration creates only the recent ones
+        month = (datetime.utcnow() - timedelta(hours=operations_per_account)).date().replace(day=1)
+        while month <= datetime.utcnow().date():
+            next_month = (month + timedelta(days=31)).replace(day=1)
+            connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS account_operations_y{:%Y}m{:%m} PARTITION OF account_operations "
+                "FOR VALUES FROM ('{}') TO ('{}')".format(month, month, month, next_month)))
+            month = next_month
+        connection.execute(text("""
+            INSERT INTO account_operations (id, account_id, amount_diff, created_at, description)
+            SELECT md5('operation' || accounts.id || n)::uuid, accounts.id, 10, now() - n * interval '1 hour',
+                   'Seed operation'
+            FROM accounts, generate_series(1, :operations) n"""), params)
+        connection.execute(text("""
+            INSERT INTO account_balance_snapshots (account_id, taken_at, amount, total_in, total_out)
+            SELECT id, now() - interval '1 day', amount, amount, 0 FROM accounts"""))
+        connection.execute(text("""
+            INSERT INTO currency_rates_history (char_code, date, value)
+            SELECT char_code, current_date - n, value FROM currencies, generate_series(0, 3650) n
+            ON CONFLICT DO NOTHING"""))
+        connection.execute(text("""
+            INSERT INTO idempotency_keys (user_id, key, request_hash, response, created_at, expires_at)
+            SELECT md5('user' || i)::uuid, 'seed', 'hash', '{}', now(), now() + interval '1 day'
+            FROM generate_series(1, :users, 2) i"""), params)
+        connection.execute(text("""
+            INSERT INTO email_outbox (id, recipients, subject, body, created_at, attempts, next_attempt_at, sent_at)
+            SELECT md5('email' || i)::uuid, '["user@example.com"]', 'Seed', 'Seed', now(), 1, now(), now()
+            FROM generate_series(1, :users) i"""), params)
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(text('ANALYZE'))
+
+
+async def scenario():
+    """
+    Calls the controller methods with the data of a seeded client
+    """
+    from fastapi import HTTPException
+    from analytics import AccountAnalytics
+    from controller import User, Account, AccountOperation, AccountBalance, IdempotencyKey, Currency
+    from mailer import Outbox
+    from schema import AccountCreate, AccountOperationCreate, AccountOperationBatch
+
+    async def call(coroutine):
+        try:
+            return await coroutine
+        except HTTPException:
+            return None
+
+    now = datetime.utcnow()
+    user = await User.get_user(email='user1@example.com')
+    await User.get_user(phone='+70000000001')
+    await User.get_user(user_id=user.id)
+    await User.email_confirmation('000000')
+    await User.update_phone(user, '+79990000000')
+    await User.confirm_update_request(user, '000000')
+    await User.update_fio(user, 'Петр', 'Петров', None)
+
+    await Currency.load_rates()
+    await Currency.get_rate_on('USD', now.date() - timedelta(days=30))
+    await call(Account.create(AccountCreate(currency_code='USD', amount=0), user))
+    user_accounts = await Account.get_by_user(user)
+    account_id, second_account_id = user_accounts[0]['id'], user_accounts[1]['id']
+    await Account.get_by_id(account_id, user)
+    await Account.get_summary(user, 'EUR')
+    # Transfers to the second account go through pending credits
+    await Account.set_hot(second_account_id, user, True)
+    await call(Account.delete(uuid.uuid4(), user))
+
+    deposit = AccountOperationCreate(account_id=account_id, amount_diff=Decimal('10.00'), description='Deposit')
+    transfer = AccountOperationCreate(account_id=account_id, amount_diff=Decimal('-10.00'),
+                                      recipient_account=second_account_id, description='Transfer')
+
+    async def create():
+        return {'account_operation_id': await AccountOperation.create(deposit, user)}
+
+    await IdempotencyKey.run(user, 'plans-{}'.format(uuid.uuid4()), deposit, create)
+    await AccountOperation.create(transfer, user)
+    await AccountOperation.create_batch(AccountOperationBatch(items=[deposit, transfer]).items, user)
+    operations = await AccountOperation.get_by_account(account_id, limit=50)
+    await AccountOperation.get_by_account(
+        account_id, limit=50, after=AccountOperation.encode_cursor(operations[-1]),
+        date_from=now - timedelta(days=7), date_to=now)
+    await AccountOperation.get_by_user(user, limit=50)
+    async for _ in AccountOperation.export(account_id, date_from=now - timedelta(days=1)):
+        pass
+
+    await AccountBalance.get_at(account_id, now - timedelta(hours=12))
+    await AccountBalance.get_turnover(account_id, now - timedelta(days=2), now - timedelta(hours=1))
+    await AccountAnalytics.get(account_id, now - timedelta(days=2), now - timedelta(hours=1))
+    await AccountBalance.take_snapshots()
+    await Account.rollup_pending_credits()
+    await IdempotencyKey.delete_expired()
+
+    messages = await Outbox.claim_batch()
+    await Outbox.mark_sent([message['id'] for message in messages])
+    await Outbox.mark_failed(uuid.uuid4(), 1, 'Plans check')
+
+
+async def capture(monkeypatch):
+    """
+    Runs the scenario in a transaction that is rolled back and returns the recorded statements
+    """
+    from db import db
+
+    recorder = QueryRecorder(db)
+    await db.connect()
+    try:
+        async with db.transaction(force_rollback=True):
+            recorder.install(monkeypatch)
+            await scenario()
+    finally:
+        await db.disconnect()
+    return recorder.statements
+
+
+def check(engine, statements):
+    """
+    Explains recorded statements and reports sequential scans of large tables
+    :return: list of (caller, scanned relations, statement) failures
+    """
+    failures = []
+    checked = set()
+    with engine.connect() as connection:
+        empty_partitions = {row[0] for row in connection.execute(EMPTY_PARTITIONS)}
+        for caller, statement in statements:
+            compiled = str(statement.compile(dialect=engine.dialect))
+            if (caller, compiled) in checked:
+                continue
+            checked.add((caller, compiled))
+            plan = explain(connection, statement)
+            allowed = FULL_SCANS_ALLOWED.get(caller, set())
+            scanned = [relation for relation in seq_scans(plan[0]['Plan'], empty_partitions)
+                       if relation in LARGE_TABLES and relation not in allowed]
+            if scanned:
+                failures.append((caller, scanned, compiled))
+    return failures
+
+
+@needs_database
+def test_no_sequential_scans_of_large_tables(monkeypatch):
+    engine = create_engine(os.environ['DATABASE_URL'])
+    seed(engine, int(os.environ.get('QUERY_PLANS_USERS', 20000)), 20)
+    statements = asyncio.run(capture(monkeypatch))
+    assert statements
+    failures = check(engine, statements)
+    assert not failures, '\n\n'.join(
+        '{} reads {} with a sequential scan:\n{}'.format(caller, ', '.join(scanned), compiled)
+        for caller, scanned, compiled in failures)
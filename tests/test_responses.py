@@ -0,0 +1,91 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from responses import ORJSONResponse, record_dict
+
+needs_database = pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+
+
+class DriverUUID(uuid.UUID):
+    """
+    Stands for the UUID class of asyncpg, a uuid.UUID subclass orjson does not serialize
+    """
+
+
+def encoded(content):
+    # Body of the default FastAPI response
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def test_render_matches_jsonable_encoder():
+    account_id = uuid.uuid4()
+    content = {
+        str(account_id): [{
+            'id': DriverUUID(str(uuid.uuid4())),
+            'account_id': account_id,
+            'amount_diff': Decimal('-755.10'),
+            'created_at': datetime(2021, 11, 20, 10, 30, 15, 1500),
+            'description': 'Денежный перевод'}, {
+            'id': uuid.uuid4(),
+            'account_id': DriverUUID(str(account_id)),
+            'amount_diff': Decimal('25.00'),
+            'created_at': datetime(2021, 11, 20, 10, 31),
+            'description': None}]}
+    assert ORJSONResponse(content).body == encoded(content)
+
+
+@needs_database
+def test_list_endpoints_match_jsonable_encoder(create_user):
+    import httpx
+
+    import view
+    from app import shutdown, startup
+    from controller import Account, AccountOperation, User
+    from db import db
+    from models import account_operations
+    from schema import AccountEntry, AccountOperationCreate, AccountOperationEntry
+
+    async def run():
+        await startup()
+        try:
+            user, account_ids = await create_user(RUB='1000.00', USD='10.00')
+            for amount in ('500.10', '-0.10', '25'):
+                await AccountOperation.create(AccountOperationCreate(
+                    account_id=account_ids['RUB'], amount_diff=amount, description='Пополнение'), user)
+            # Time without microseconds is formatted differently by some encoders
+            await db.execute(account_operations.insert().values(
+                id=uuid.uuid4(), account_id=account_ids['RUB'], amount_diff=Decimal('-1.00'),
+                created_at=datetime.utcnow().replace(microsecond=0), description=None))
+
+            headers = {'Authorization': 'Bearer {}'.format(User.create_access_token(user.email))}
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=view.app), base_url='http://test') as client:
+                accounts_response = await client.get('/accounts/', headers=headers)
+                account_response = await client.get(
+                    '/accounts/operations/', params={'account_id': str(account_ids['RUB'])}, headers=headers)
+                user_response = await client.get('/accounts/operations/', headers=headers)
+            assert accounts_response.status_code == 200
+            assert account_response.status_code == 200
+            assert user_response.status_code == 200
+
+            # Bodies before orjson: Pydantic models of every row encoded by jsonable_encoder
+            accounts = [AccountEntry(**record_dict(record)) for record in await Account.get_by_user(user)]
+            assert accounts_response.content == encoded(accounts)
+            operations = [AccountOperationEntry(**record_dict(record))
+                          for record in await AccountOperation.get_by_account(account_ids['RUB'])]
+            assert len(operations) == 4
+            assert account_response.content == encoded(operations)
+            user_operations = {account_id: [AccountOperationEntry(**record_dict(record))
+                                            for record in await AccountOperation.get_by_account(account_id)]
+                               for account_id in sorted(account_ids.values())}
+            assert user_response.content == encoded(user_operations)
+        finally:
+            await shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from db import InstrumentedDatabase, pool_acquire_timeouts, pool_acquire_wait
+
+needs_database = pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+
+
+def test_connect_creates_instrumented_pool(monkeypatch):
+    # An empty pool is created without opening connections, so no server is needed
+    monkeypatch.setenv('DB_POOL_MIN_SIZE', '0')
+    database = InstrumentedDatabase(os.environ['DATABASE_URL'], name='test')
+
+    async def connect():
+        await database.connect()
+        try:
+            assert database.is_connected
+            assert database._pool.get_size() == 0
+        finally:
+            await database.disconnect()
+
+    asyncio.run(connect())
+
+
+@needs_database
+def test_app_startup():
+    from app import startup, shutdown
+    from db import db
+
+    async def run():
+        await startup()
+        try:
+            assert await db.fetch_val('SELECT 1') == 1
+        finally:
+            await shutdown()
+
+    asyncio.run(run())
+
+
+@needs_database
+def test_acquire_timeout_is_503(monkeypatch):
+    monkeypatch.setenv('DB_POOL_MIN_SIZE', '1')
+    monkeypatch.setenv('DB_POOL_MAX_SIZE', '1')
+    monkeypatch.setenv('DB_POOL_ACQUIRE_TIMEOUT', '0.1')
+    database = InstrumentedDatabase(os.environ['DATABASE_URL'], name='test_timeout')
+
+    async def run():
+        await database.connect()
+        try:
+            held = database._backend.connection()
+            await held.acquire()
+            try:
+                with pytest.raises(HTTPException) as error:
+                    await database._backend.connection().acquire()
+                assert error.value.status_code == 503
+            finally:
+                await held.release()
+        finally:
+            await database.disconnect()
+
+    asyncio.run(run())
+    assert pool_acquire_timeouts.labels('test_timeout').value == 1
+    assert pool_acquire_wait.labels('test_timeout').count == 2
@@ -1,15 +1,25 @@
+import json
+from datetime import date, datetime
 from typing import List
+from uuid import UUID
 
 import uvicorn
-from fastapi import Depends, HTTPException
+from fastapi import Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from starlette import status
 
 from controller import User as UserController, Account as AccountController, Currency as CurrencyController, \
-    AccountOperation as AccountOperationController
+    AccountOperation as AccountOperationController, IdempotencyKey as IdempotencyKeyController, \
+    AccountBalance as AccountBalanceController
 from schema import UserCreate, UserEntry, Token, AccountCreate, CurrencyCreate, AccountOperationCreate, AccountEntry, \
-    UserUpdatePassword, UserUpdateEmail, UserUpdatePhone, UserConfirmation, UserUpdate, UserResponse
+    UserUpdatePassword, UserUpdateEmail, UserUpdatePhone, UserConfirmation, UserUpdate, UserResponse, CurrencyRateEntry, \
+    AccountOperationBatch, AccountOperationBatchResult, AccountBalanceEntry, AccountTurnoverEntry, AccountsSummary, \
+    AccountAnalyticsEntry
+from analytics import AccountAnalytics as AccountAnalyticsController
 from app import app
+from responses import ORJSONResponse
+from metrics import registry
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -131,49 +141,167 @@ async def account_create(data: AccountCreate, current_user: UserEntry = Depends(
 
 
 @app.get("/accounts/")
-async def account_get(account_id: str = None, current_user: UserEntry = Depends(get_current_user)):
+async def account_get(account_id: UUID = None, current_user: UserEntry = Depends(get_current_user)):
     """
     Пользователь имеет возможность посмотреть состояние лицевого счета/лицевых счетов.
     """
     if account_id:
         return await AccountController.get_by_id(account_id=account_id, user=current_user)
     else:
-        return await AccountController.get_by_user(user=current_user)
+        # Records are serialized as is, without building a Pydantic model per account
+        return ORJSONResponse(await AccountController.get_by_user(user=current_user))
+
+
+@app.get("/accounts/summary/", response_model=AccountsSummary)
+async def account_summary_get(currency: str, current_user: UserEntry = Depends(get_current_user)):
+    """
+    Остатки всех лицевых счетов пользователя, пересчитанные в указанную валюту по текущему курсу, и их сумма.
+    """
+    return await AccountController.get_summary(user=current_user, currency_code=currency)
 
 
 @app.post("/accounts/delete/")
-async def account_delete(account_id: str, current_user: UserEntry = Depends(get_current_user)):
+async def account_delete(account_id: UUID, current_user: UserEntry = Depends(get_current_user)):
     """
     Пользователь имеет возможность закрыть лицевой счет.
     """
     await AccountController.delete(account_id=account_id, user=current_user)
     return {'status': 'ok'}
 
+
+@app.post("/accounts/hot/")
+async def account_set_hot(account_id: UUID, is_hot: bool = True, current_user: UserEntry = Depends(get_current_user)):
+    """
+    Пользователь имеет возможность включить режим "горячего" счета для счетов, на которые одновременно приходит много
+    переводов (зарплатные, торговые). Зачисления на такой счет не ждут друг друга: они сохраняются отдельно и
+    добавляются к остатку фоновой задачей, остаток счета при этом всегда учитывает все зачисления.
+    """
+    await AccountController.set_hot(account_id=account_id, user=current_user, is_hot=is_hot)
+    return {'status': 'ok'}
+
+
+@app.get("/accounts/balance/", response_model=AccountBalanceEntry)
+async def account_balance_get(account_id: UUID, at: datetime, current_user: UserEntry = Depends(get_current_user)):
+    """
+    Состояние лицевого счета на указанный момент времени (операции, созданные до этого момента).
+    """
+    await AccountController.get_by_id(account_id=account_id, user=current_user)
+    return await AccountBalanceController.get_at(account_id=account_id, at=at)
+
+
+@app.get("/accounts/turnover/", response_model=AccountTurnoverEntry)
+async def account_turnover_get(account_id: UUID, date_from: datetime, date_to: datetime,
+                               current_user: UserEntry = Depends(get_current_user)):
+    """
+    Обороты по лицевому счету за период: остаток на начало и конец периода, сумма поступлений и списаний. Период
+    включает date_from и не включает date_to, как в истории операций.
+    """
+    await AccountController.get_by_id(account_id=account_id, user=current_user)
+    return await AccountBalanceController.get_turnover(account_id=account_id, date_from=date_from, date_to=date_to)
+
+
+@app.get("/accounts/analytics/", response_model=AccountAnalyticsEntry)
+async def account_analytics_get(account_id: UUID, date_from: datetime, date_to: datetime,
+                                current_user: UserEntry = Depends(get_current_user)):
+    """
+    Аналитика по лицевому счету за период: обороты по дням (поступления, списания, количество операций), остаток на
+    конец дня, минимальный и максимальный остаток за день и за весь период. Дни без операций не выводятся.
+    """
+    await AccountController.get_by_id(account_id=account_id, user=current_user)
+    return await AccountAnalyticsController.get(account_id=account_id, date_from=date_from, date_to=date_to)
+
 # Account operations
 
 @app.post("/accounts/operations/")
-async def account_operation_create(data: AccountOperationCreate, current_user: UserEntry = Depends(get_current_user)):
+async def account_operation_create(data: AccountOperationCreate, idempotency_key: str = Header(None),
+                                   current_user: UserEntry = Depends(get_current_user)):
     """
     Пользователь имеет возможность пополнить лицевой счет, снять деньги с лицевого счета, отправить определенную
     денежную сумму другому пользователю банка на его банковский счет (для этого заполните поле recipient_account).
     При переводе с одного счета на другой учитываются валюты.
+    Если передан заголовок Idempotency-Key, повторный запрос с тем же ключом не создает новую операцию, а возвращает
+    ответ первого запроса.
     """
-    account_operation_id = await AccountOperationController.create(data=data, user=current_user)
-    return {'account_operation_id': account_operation_id}
+    async def create():
+        account_operation_id = await AccountOperationController.create(data=data, user=current_user)
+        return {'account_operation_id': account_operation_id}
+
+    if idempotency_key:
+        return await IdempotencyKeyController.run(current_user, idempotency_key, data, create)
+    return await create()
+
+
+@app.post("/accounts/operations/batch", response_model=List[AccountOperationBatchResult])
+async def account_operation_batch_create(data: AccountOperationBatch, idempotency_key: str = Header(None),
+                                         current_user: UserEntry = Depends(get_current_user)):
+    """
+    Пакетное создание операций (зарплатные ведомости, расчеты с продавцами) в одной транзакции. Операции проверяются
+    по порядку с учетом уже примененных операций пакета, для каждой операции возвращается результат: идентификатор
+    созданной операции или причина отказа. Поддерживается заголовок Idempotency-Key.
+    """
+    async def create_batch():
+        results = await AccountOperationController.create_batch(items=data.items, user=current_user)
+        return [result.dict() for result in results]
+
+    if idempotency_key:
+        return await IdempotencyKeyController.run(current_user, idempotency_key, data, create_batch)
+    return await create_batch()
 
 
 @app.get("/accounts/operations/")
-async def account_operation_get(account_id: str = None, current_user: UserEntry = Depends(get_current_user)):
+async def account_operation_get(account_id: UUID = None,
+                                limit: int = Query(None, ge=1, le=1000), after: str = None,
+                                date_from: datetime = None, date_to: datetime = None,
+                                current_user: UserEntry = Depends(get_current_user)):
     """
     Пользователь имеет возможность посмотреть историю операций по счету (в том числе, кому перевел, сколько перевел,
     в какой валюте), по всем счетам.
+    Без limit отдается вся история, с limit - страницами по limit операций (для всех счетов - не более limit операций
+    на счет), можно ограничить период полями date_from и date_to. Если по счету есть следующая страница, ее курсор
+    возвращается в заголовке X-Next-Cursor, передайте его в поле after. Для всех счетов курсоры счетов, у которых есть
+    следующая страница, возвращаются в заголовке X-Next-Cursors (JSON-объект идентификатор счета - курсор), остальные
+    операции такого счета запрашиваются с его account_id и after.
     """
+    # Records are serialized as is, without building a Pydantic model per operation
     if account_id:
         await AccountController.get_by_id(account_id=account_id, user=current_user)
-        account_operations = await AccountOperationController.get_by_account(account_id=account_id)
+        account_operations = await AccountOperationController.get_by_account(
+            account_id=account_id, limit=limit, after=after, date_from=date_from, date_to=date_to)
+        account_operations, next_cursor = AccountOperationController.split_page(account_operations, limit)
+        response = ORJSONResponse(account_operations)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
     else:
-        account_operations = await AccountOperationController.get_by_user(user=current_user)
-    return account_operations
+        account_operations = await AccountOperationController.get_by_user(
+            user=current_user, limit=limit, date_from=date_from, date_to=date_to)
+        next_cursors = {}
+        for operations_account_id, operations in account_operations.items():
+            account_operations[operations_account_id], next_cursor = AccountOperationController.split_page(
+                operations, limit)
+            if next_cursor:
+                next_cursors[operations_account_id] = next_cursor
+        response = ORJSONResponse(account_operations)
+        if next_cursors:
+            response.headers['X-Next-Cursors'] = json.dumps(next_cursors)
+        return response
+
+
+@app.get("/accounts/operations/export/")
+async def account_operation_export(account_id: UUID, format: str = Query('ndjson', regex='^(ndjson|csv)$'),
+                                   date_from: datetime = None, date_to: datetime = None,
+                                   current_user: UserEntry = Depends(get_current_user)):
+    """
+    Выписка по счету за весь период или за период date_from - date_to в формате NDJSON или CSV. Выписка передается
+    потоком по мере чтения из базы данных, поэтому подходит для счетов с длинной историей.
+    """
+    await AccountController.get_by_id(account_id=account_id, user=current_user)
+    media_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(
+        AccountOperationController.export(
+            account_id=account_id, export_format=format, date_from=date_from, date_to=date_to),
+        media_type=media_type,
+        headers={'Content-Disposition': 'attachment; filename="statement_{}.{}"'.format(account_id, format)})
 
 
 # Currencies
@@ -193,9 +321,27 @@ async def currency_fetch():
     """
     Эндпоинт для определения валютного курса, если лень ждать автоматической задачи, исполняемой раз в 24 часа.
     """
-    await CurrencyController.fetch_currencies(is_schedule_task=False)
+    await CurrencyController.fetch_currencies()
     return {'status': 'ok'}
 
+
+@app.get("/currencies/rates/", response_model=CurrencyRateEntry)
+async def currency_rate_get(char_code: str, on_date: date):
+    """
+    Курс валюты, действовавший на указанную дату (из истории курсов, без обращения к Центральному Банку).
+    """
+    return await CurrencyController.get_rate_on(char_code=char_code, on_date=on_date)
+
+# Service
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_get():
+    """
+    Метрики процесса в формате Prometheus: время обработки запросов по эндпоинтам, время запросов к базе данных по
+    методам контроллеров, пул соединений, хеширование паролей, отправка писем и запросы к Центральному Банку.
+    """
+    return Response(registry.render(), media_type='text/plain; version=0.0.4')
+
 # Entry point
 
 if __name__ == "__main__":